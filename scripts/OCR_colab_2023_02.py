@@ -15,7 +15,7 @@ from statistics import mode
 import json
 from geojson import Feature, FeatureCollection, Point
 from osgeo import gdal
-from pyproj import CRS, Transformer
+from reprojection_2023_03 import transform_coordinates
 
 
 def detect_num(image):
@@ -217,16 +217,20 @@ def detect_stickers(imgname, jsonname, bmin, bmax, gmin, gmax, rmin, rmax, epsg)
     dy2=info['geoTransform'][5]
     
     features = []
-
+    
+    projected = []
     for i in range(len(centroids)):
         
         centx=upleft_x+(centroids[i][0]*dx1+centroids[i][0]*dy1) #x projected coordinate
         centy=upleft_y+(centroids[i][1]*dx2+centroids[i][1]*dy2) #y projected coordinate
+        projected.append([centx, centy])
         
-        #reproject to WGS84   
+    #reproject all centroids to WGS84 at once, with a single transformer (see reprojection_2023_03)
+    reprojected = transform_coordinates(projected, epsg, 'EPSG:4326')
+
+    for i in range(len(centroids)):
         
-        transformer = Transformer.from_crs(epsg, 'EPSG:4326')
-        reprojected_x, reprojected_y = transformer.transform(centx, centy)
+        reprojected_x, reprojected_y = reprojected[i]
         
         #Y comes first, then X
         features.append(
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the digitization scripts, run on synthetic sketch maps so that the timings can be reproduced.
+
+Note: the entry function, if any, is specified last. The keyword (ENTRY) is mentioned in the comments
+describing that function. The entry function is the one that is called first among all functions.
+All other functions are listed in the alphabetical order
+
+Steps
+-----
+generate a synthetic sketch map (white paper, dark parcel boundaries)
+time the per-patch and the whole-raster preprocessing of the boundary extraction
+time the marker methods of the watershed
+time the seam-only second pass against the shifted patch grid
+time the contour filtering of the vectorizer on a dense skeleton
+time the generalization in memory of the parcels, with parcels drawn inside other ones
+time the skeleton of the vectorizer against the one of skimage
+-----
+"""
+
+
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np # mathematical functions on multi-dimensional arrays and matrices
+import shapely
+
+from skimage.morphology import skeletonize
+
+import boundary_extractor_blur_2023_02 as extractor
+import parcels_2023_03 as parcels
+
+
+# time contours_from_mask on a dense synthetic skeleton of size x size pixels (parcels of about parcel_size pixels, 
+# with one stray stroke per parcel, as left by the boundary extraction, and closed loops, some of them inside a parcel, 
+# see draw_closed_loops), against the previous filtering (see two_call_contours)
+# returns the time of both, the number of inner polygons of each, the number of outer contours of components inside a 
+# parcel among the previous ones: the outlines of the strokes (no area) and of the closed loops, whose parcel came out 
+# twice before (outer contour and hole), and whether both are the same once these outer contours are dropped
+def benchmark_contours(size, parcel_size, seed): 
+    
+    n_parcels = int(size*size/parcel_size**2)
+    sketch = synthetic_sketch(size, n_parcels, seed)
+    
+    # stray strokes, each one is a separate component of the skeleton
+    rng = np.random.default_rng(seed)
+    for start, length, angle in zip(rng.uniform(0, size, size=(n_parcels, 2)), rng.uniform(5, 20, n_parcels), 
+                                    rng.uniform(0, np.pi, n_parcels)): 
+        end = start + length*np.array([np.cos(angle), np.sin(angle)])
+        cv2.line(sketch, tuple(np.round(start).astype(int).tolist()), tuple(np.round(end).astype(int).tolist()), (40, 40, 40), 3)
+    draw_closed_loops(sketch, n_parcels, 3*parcel_size//2, seed)
+    
+    skeleton = skeletonize(cv2.cvtColor(sketch, cv2.COLOR_BGR2GRAY) < 128).astype(np.uint8)*255
+    
+    results = {}
+    start = time.perf_counter()
+    polygons = parcels.contours_from_mask(skeleton)
+    results['hierarchy'] = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    reference = two_call_contours(skeleton)
+    results['two_calls'] = time.perf_counter() - start
+    
+    results['polygons'], results['reference_polygons'] = len(polygons), len(reference)
+    # the holes turn the other way round than the outer contours
+    orientations = np.sign([cv2.contourArea(c, oriented=True) for c in reference])
+    results['strokes'], results['loops'] = int(np.sum(orientations == 0)), int(np.sum(orientations < 0))
+    reference = [c for c, orientation in zip(reference, orientations) if orientation > 0]
+    results['same'] = len(polygons) == len(reference) and all(np.array_equal(a, b) for a, b in zip(polygons, reference))
+    
+    return results
+
+
+# generalize the parcels of a synthetic sketch map with closed loops in it (parcels drawn inside other ones, see 
+# draw_closed_loops) as postprocess_native does (see generalize_parcels), in pixel coordinates with a threshold of one pixel
+# returns the time of the generalization, the number of parcels and of areas, and whether every parcel kept an area
+def benchmark_generalization(size, parcel_size, seed): 
+    
+    n_parcels = int(size*size/parcel_size**2)
+    sketch = synthetic_sketch(size, n_parcels, seed)
+    draw_closed_loops(sketch, n_parcels, parcel_size, seed)
+    skeleton = skeletonize(cv2.cvtColor(sketch, cv2.COLOR_BGR2GRAY) < 128).astype(np.uint8)*255
+    contours = parcels.contours_from_mask(skeleton)
+    
+    # polygons of the contours as contour_polygons builds them, without the georeferencing, and without their holes
+    rings = shapely.linearrings(np.concatenate(contours).astype(float), 
+                                indices=np.repeat(np.arange(len(contours)), [len(cnt) for cnt in contours]))
+    polygons, origins = parcels.parcel_exteriors(list(shapely.buffer(shapely.polygons(rings), 0, join_style='mitre')))
+    
+    results = {}
+    start = time.perf_counter()
+    areas, parcel_ids = parcels.generalize_parcels(polygons, np.arange(1, len(polygons) + 1), 1.0)
+    results['seconds'] = time.perf_counter() - start
+    results['parcels'], results['areas'] = len(polygons), len(areas)
+    results['all_parcels'] = len(np.unique(parcel_ids)) == len(polygons)
+    
+    return results
+
+
+# compare the marker methods of the watershed on the patches of a synthetic sketch map
+# methods: list of (marker_method, marker_param) pairs; returns, per method, the time spent on the markers,
+# the number of markers and the share of pixels on which the boundaries agree with the first method
+def benchmark_markers(size, patch_size, thres, methods):
+
+    sketch = synthetic_sketch(size, int(size*size/150**2), 0)
+    patches = extractor.patch_grid(sketch, patch_size, 0, 0, size - size % patch_size, size - size % patch_size)
+    raster_shape = (1, patches.shape[0]*patch_size, patches.shape[1]*patch_size)
+
+    results = {}
+    reference = None
+    for marker_method, marker_param in methods:
+        masks = np.zeros(raster_shape, dtype=np.uint8)
+        stats = extractor.label_patches([(patches, masks, 0, 0, patch_size)], [thres], False, None, 8,
+                                        marker_method, marker_param, None)
+        if reference is None:
+            reference = masks
+        results[(marker_method, marker_param)] = {'seconds': stats['marker_seconds'], 'markers': stats['markers'],
+                                                  'agreement': float(np.mean(masks == reference))}
+
+    return results
+
+
+# time the boundary extraction of a synthetic sketch map with the filters run per patch and once per raster
+# returns the best time of each mode over the repeats, and the share of pixels on which both modes agree
+def benchmark_preprocessing(size, patch_size, thres, n_passes, repeats, workers):
+
+    sketch = synthetic_sketch(size, int(size*size/150**2), 0)
+    patch_shape = (patch_size, patch_size, 3)
+    offsets = extractor.grid_offsets(patch_size, n_passes)
+
+    results = {}
+    # the same workers for all runs, as extract_boundaries starts them once (see create_executor)
+    with tempfile.TemporaryDirectory() as tmp_dir, extractor.create_executor(workers, 'process') as executor:
+        sketch_path = os.path.join(tmp_dir, 'sketch.png')
+        cv2.imwrite(sketch_path, sketch)
+
+        boundaries = {}
+        for preprocess in ['patch', 'raster']:
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                boundaries[preprocess] = extractor.boundaries_in_memory(sketch_path, patch_shape, [thres], False, False,
+                                                                        offsets, executor, 8, preprocess, 1024, 64,
+                                                                        'peaks', None, None, None, 16, None)[0]
+                timings.append(time.perf_counter() - start)
+            results[preprocess] = min(timings)
+
+    results['speedup'] = results['patch']/results['raster']
+    results['agreement'] = float(np.mean(boundaries['patch'] == boundaries['raster']))
+
+    return results
+
+
+# time the boundary extraction of a synthetic sketch map with a second pass on a shifted patch grid and on the seams only
+# returns the best time of each mode over the repeats, the share of pixels on which both modes agree, and the share of the 
+# boundary pixels of the shifted grid mode that the seam mode finds
+def benchmark_seams(size, patch_size, thres, seam_width, repeats, workers): 
+    
+    sketch = synthetic_sketch(size, int(size*size/150**2), 0)
+    patch_shape = (patch_size, patch_size, 3)
+    
+    results = {}
+    # the same workers for all runs, as extract_boundaries starts them once (see create_executor)
+    with tempfile.TemporaryDirectory() as tmp_dir, extractor.create_executor(workers, 'process') as executor: 
+        sketch_path = os.path.join(tmp_dir, 'sketch.png')
+        cv2.imwrite(sketch_path, sketch)
+        
+        boundaries = {}
+        for mode, offsets, mode_seam_width in [('grid', extractor.grid_offsets(patch_size, 2), None), ('seams', [0], seam_width)]: 
+            timings = []
+            for _ in range(repeats): 
+                start = time.perf_counter()
+                boundaries[mode] = extractor.boundaries_in_memory(sketch_path, patch_shape, [thres], False, False, 
+                                                                  offsets, executor, 8, 'patch', 1024, 64, 
+                                                                  'peaks', None, None, None, 16, mode_seam_width)[0]
+                timings.append(time.perf_counter() - start)
+            results[mode] = min(timings)
+    
+    results['speedup'] = results['grid']/results['seams']
+    results['agreement'] = float(np.mean(boundaries['grid'] == boundaries['seams']))
+    results['recall'] = float(np.count_nonzero(boundaries['grid'] & boundaries['seams'])/max(np.count_nonzero(boundaries['grid']), 1))
+    
+    return results
+
+
+# time skeletonize_mask on the boundaries of a synthetic sketch map of size x size pixels (parcels of about parcel_size 
+# pixels) for each tile size, against skimage.morphology.skeletonize on the whole mask
+# returns the time of skimage, and per tile size, the time and the number of pixels that differ from the skeleton of skimage
+def benchmark_skeleton(size, parcel_size, tile_sizes, seed): 
+    
+    sketch = synthetic_sketch(size, int(size*size/parcel_size**2), seed)
+    mask = (cv2.cvtColor(sketch, cv2.COLOR_BGR2GRAY) < 128).view(np.uint8)
+    
+    results = {}
+    start = time.perf_counter()
+    reference = skeletonize(mask).astype(np.uint8)*255
+    results['skimage'] = time.perf_counter() - start
+    
+    for tile_size in tile_sizes: 
+        start = time.perf_counter()
+        skeleton = parcels.skeletonize_mask(mask, tile_size)
+        results[tile_size] = {'seconds': time.perf_counter() - start, 'wrong': int(np.count_nonzero(skeleton != reference))}
+    
+    return results
+
+
+# draw n_loops closed rectangles (about a fifth of loop_size wide) at random places of a sketch map, in place: 
+# most of them are parcels drawn inside another parcel
+def draw_closed_loops(sketch, n_loops, loop_size, seed): 
+    
+    rng = np.random.default_rng(seed)
+    size = sketch.shape[0]
+    for x, y in rng.uniform(0.1*size, 0.9*size, size=(n_loops, 2)).astype(int): 
+        cv2.rectangle(sketch, (int(x), int(y)), (int(x) + loop_size//5, int(y) + loop_size//6), (40, 40, 40), 3)
+
+
+# generate a synthetic sketch map of size x size pixels: parcels are the cells of a voronoi diagram of n_parcels random points,
+# drawn as dark lines of varying width on slightly noisy white paper
+def synthetic_sketch(size, n_parcels, seed):
+
+    rng = np.random.default_rng(seed)
+
+    sketch = np.full((size, size, 3), 255, dtype=np.uint8)
+
+    subdiv = cv2.Subdiv2D((0, 0, size, size))
+    for point in rng.uniform(1, size - 1, size=(max(n_parcels, 2), 2)):
+        subdiv.insert((float(point[0]), float(point[1])))
+    facets, _ = subdiv.getVoronoiFacetList([])
+
+    for facet in facets:
+        cv2.polylines(sketch, [np.round(facet).astype(np.int32)], True, (40, 40, 40), int(rng.integers(2, 6)))
+
+    # paper texture
+    noise = rng.integers(0, 25, size=sketch.shape, dtype=np.uint8)
+
+    return cv2.subtract(sketch, noise)
+
+
+# inner polygons of a skeleton as they were filtered before contours_from_mask used the hierarchy: RETR_CCOMP contours 
+# with at least 3 points that are not equal to any RETR_EXTERNAL contour (pairwise comparison), kept for the benchmark
+def two_call_contours(image): 
+    
+    contours_ei = [np.squeeze(c) for c in cv2.findContours(image, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)[0]]
+    contours_e = [np.squeeze(c) for c in cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]]
+    
+    return [c for c in contours_ei if len(c) >= 3 and not any(np.array_equal(c, e) for e in contours_e)]
+
+
+# (ENTRY) print the timings of the benchmarks
+def run_benchmarks(sizes=(1000, 2000, 4000), patch_size=256, thres=60, passes=(2, 4), repeats=3, workers=1,
+                   marker_methods=(('peaks', 1), ('peaks', 5), ('hmaxima', 1.0), ('edt_threshold', 2.0)), seam_width=64, 
+                   contour_parcel_size=40, generalization_parcel_size=150, skeleton_parcel_size=150, 
+                   skeleton_tiles=(64, 256, 4096)):
+
+    for size in sizes:
+        for n_passes in passes:
+            results = benchmark_preprocessing(size, patch_size, thres, n_passes, repeats, workers)
+            print(f"{size} x {size} pixels, {n_passes} passes: per patch {results['patch']:.2f} s, "
+                  f"whole raster {results['raster']:.2f} s, speedup {results['speedup']:.2f}x, "
+                  f"same pixels {100*results['agreement']:.2f} %")
+
+        results = benchmark_markers(size, patch_size, thres, marker_methods)
+        for (marker_method, marker_param), method_results in results.items():
+            print(f"{size} x {size} pixels, markers {marker_method} ({marker_param}): {method_results['seconds']:.2f} s, "
+                  f"{method_results['markers']} markers, same pixels {100*method_results['agreement']:.2f} %")
+        
+        results = benchmark_seams(size, patch_size, thres, seam_width, repeats, workers)
+        print(f"{size} x {size} pixels, second pass: shifted grid {results['grid']:.2f} s, seams ({seam_width} pixels) "
+              f"{results['seams']:.2f} s, speedup {results['speedup']:.2f}x, same pixels {100*results['agreement']:.2f} %, "
+              f"boundary pixels found {100*results['recall']:.2f} %")
+        
+        results = benchmark_contours(size, contour_parcel_size, 0)
+        print(f"{size} x {size} pixels, skeleton contours: hierarchy {results['hierarchy']:.2f} s, "
+              f"two calls {results['two_calls']:.2f} s ({results['two_calls']/results['hierarchy']:.0f}x), "
+              f"{results['polygons']} inner polygons ({results['reference_polygons']} before, with {results['strokes']} "
+              f"stroke outlines and {results['loops']} closed loops inside a parcel twice), same: {results['same']}")
+        
+        results = benchmark_generalization(size, generalization_parcel_size, 0)
+        print(f"{size} x {size} pixels, generalization: {results['seconds']:.2f} s, {results['parcels']} parcels "
+              f"({results['areas']} areas), every parcel kept: {results['all_parcels']}")
+        
+        results = benchmark_skeleton(size, skeleton_parcel_size, skeleton_tiles, 0)
+        for tile_size in skeleton_tiles: 
+            print(f"{size} x {size} pixels, skeleton on tiles of {tile_size} pixels: {results[tile_size]['seconds']:.2f} s "
+                  f"(skimage {results['skimage']:.2f} s), {results[tile_size]['wrong']} pixels off the skeleton of skimage")
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the digitization pipeline on synthetic, georeferenced sketch maps, so that the timings of the steps
+can be compared between commits.
+
+Note: the entry function, if any, is specified last. The keyword (ENTRY) is mentioned in the comments
+describing that function. The entry function is the one that is called first among all functions.
+All other functions are listed in the alphabetical order
+
+Steps
+-----
+generate a synthetic sketch map per size (parcels of known boundaries, stickers of known numbers and positions)
+and save it as a georeferenced geotiff, with the ground truth as json
+time extract_boundaries, generate_polygons, detect_stickers and analyze_relations separately
+save the timings as json (one run per call, with the commit) and compare them with the previous run
+-----
+"""
+
+
+import importlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np # mathematical functions on multi-dimensional arrays and matrices
+
+from osgeo import gdal
+from osgeo import osr
+
+
+# look of the synthetic sketch maps
+PARCEL_SIZE = 150 # mean distance between the seed points of the parcels in pixels
+STICKER_SIZE = (80, 40) # width and height of a sticker in pixels
+STICKER_COLOR = (0, 220, 255) # bgr, yellow
+STICKER_RANGE = (0, 100, 150, 255, 150, 255) # bmin, bmax, gmin, gmax, rmin, rmax of detect_stickers
+STRIP_ROWS = 2048 # the sketch maps are drawn and written strip by strip
+
+
+# time the steps of the pipeline on a synthetic sketch map of size x size pixels, the outputs are written to work_dir
+# streaming: extract the boundaries window by window (needed for the largest maps)
+# engine: postprocessing engine of generate_polygons ('native' runs without GRASS GIS)
+# returns the timings of the steps, the steps that depend on a failed step are not run
+def benchmark_pipeline(size, work_dir, seed, epsg, workers, streaming, engine):
+
+    map_path = os.path.join(work_dir, f"sketch_{size}.tif")
+    boundaries_path = os.path.join(work_dir, f"sketch_{size}_boundaries.tif")
+    parcels_path = os.path.join(work_dir, f"sketch_{size}_parcels.json") # the output is sketch_<size>_parcels.geojson
+    stickers_path = os.path.join(work_dir, f"sketch_{size}_stickers.geojson")
+
+    print(f"Generating a synthetic sketch map of {size} x {size} pixels...")
+    truth = synthetic_map(map_path, size, seed, epsg, (430000.0, 1000000.0), 0.5)
+    odk_data = [{'SpatialID': str(sticker['number'])} for sticker in truth['stickers']]
+
+    results = {}
+    extracted = time_stage(results, 'boundary_extractor_blur_2023_02', 'extract_boundaries', map_path, boundaries_path,
+                           (256, 256, 3), 60, False, False, False, workers=workers, streaming=streaming, output='geotiff')
+    polygons = extracted and time_stage(results, 'vectorizer_grass_2023_02', 'generate_polygons', map_path, boundaries_path,
+                                        epsg, parcels_path, 10, size, 1e-6, True, engine=engine)
+    stickers = time_stage(results, 'OCR_colab_2023_02', 'detect_stickers', map_path, stickers_path, *STICKER_RANGE, epsg)
+    if polygons and stickers:
+        polygons_path = importlib.import_module('parcels_2023_03').polygons_path(parcels_path)
+        time_stage(results, 'analyse_relations_2023_02', 'analyze_relations', os.path.basename(map_path), stickers_path,
+                   polygons_path, odk_data, work_dir + os.sep)
+
+    return results
+
+
+# print the timings of a run next to the ones of the previous run (ratio > 1: slower than before)
+def compare_runs(previous, current):
+
+    print(f"Comparison with the run of commit {previous['commit']} ({previous['date']})")
+    for size, stages in current['sizes'].items():
+        for stage, result in stages.items():
+            before = previous['sizes'].get(size, {}).get(stage, {})
+            if 'seconds' in result and 'seconds' in before:
+                print(f"{size} pixels, {stage}: {before['seconds']:.2f} s -> {result['seconds']:.2f} s "
+                      f"({result['seconds']/before['seconds']:.2f}x)")
+
+
+# draw the rows top to top + n_rows of a synthetic sketch map of size x size pixels: parcel boundaries (dark lines of
+# the given widths) and stickers (yellow rectangles with their number, followed by a star as on the field stickers)
+# on slightly noisy white paper; returns the bgr strip
+def draw_strip(facets, widths, stickers, top, n_rows, size, rng):
+
+    strip = np.full((n_rows, size, 3), 255, dtype=np.uint8)
+
+    # only the parcels and stickers that overlap the strip are drawn (cv2 clips the rest)
+    for facet, width in zip(facets, widths):
+        if facet[:,1].max() + width >= top and facet[:,1].min() - width < top + n_rows:
+            cv2.polylines(strip, [np.round(facet - (0, top)).astype(np.int32)], True, (40, 40, 40), int(width))
+
+    sticker_w, sticker_h = STICKER_SIZE
+    for sticker in stickers:
+        x, y = sticker['pixel']
+        if y + sticker_h >= top and y - sticker_h < top + n_rows:
+            corner = (int(x - sticker_w/2), int(y - sticker_h/2 - top))
+            cv2.rectangle(strip, corner, (corner[0] + sticker_w, corner[1] + sticker_h), STICKER_COLOR, -1)
+            cv2.putText(strip, f"{sticker['number']}*", (corner[0] + 8, corner[1] + sticker_h - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+
+    # paper texture
+    noise = rng.integers(0, 25, size=strip.shape, dtype=np.uint8)
+
+    return cv2.subtract(strip, noise)
+
+
+# hash of the current commit of the repository, or None outside of a git repository
+def git_commit():
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# generate a synthetic sketch map of size x size pixels and save it as a tiled, georeferenced geotiff (map_path),
+# the ground truth is saved next to it (_truth.json): parcels are the cells of a voronoi diagram, each with a sticker
+# at its seed point (the seed points are PARCEL_SIZE pixels apart, give or take a sixth); origin: map coordinates of the upper-left corner, pixel_size: in map units (e.g. metres)
+# returns the ground truth: parcel boundaries in pixels, sticker numbers and positions in pixels and map coordinates
+def synthetic_map(map_path, size, seed, epsg, origin, pixel_size):
+
+    rng = np.random.default_rng(seed)
+
+    # seed points on a jittered grid, so that the parcels are large enough for their stickers
+    grid = np.arange(PARCEL_SIZE/2, size, PARCEL_SIZE)
+    seeds = np.stack(np.meshgrid(grid, grid), axis=-1).reshape(-1, 2)
+    seeds = np.clip(seeds + rng.uniform(-PARCEL_SIZE/6, PARCEL_SIZE/6, size=seeds.shape), 1, size - 1)
+    subdiv = cv2.Subdiv2D((0, 0, size, size))
+    for point in seeds:
+        subdiv.insert((float(point[0]), float(point[1])))
+    facets, centers = subdiv.getVoronoiFacetList([])
+    widths = rng.integers(2, 6, size=len(facets))
+
+    geotransform = [origin[0], pixel_size, 0, origin[1], 0, -pixel_size]
+    stickers = [{'number': k + 1, 'pixel': [x, y], 'map': [origin[0] + x*pixel_size, origin[1] - y*pixel_size]}
+                for k, (x, y) in enumerate(np.asarray(centers).tolist())]
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(epsg.split(':')[-1]))
+    dataset = gdal.GetDriverByName('GTiff').Create(map_path, size, size, 3, gdal.GDT_Byte,
+                                                   options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(srs.ExportToWkt())
+
+    for top in range(0, size, STRIP_ROWS):
+        n_rows = min(STRIP_ROWS, size - top)
+        strip = draw_strip(facets, widths, stickers, top, n_rows, size, rng)
+        for b in range(3):
+            # gdal bands are RGB, cv2 strips are BGR
+            dataset.GetRasterBand(b + 1).WriteArray(strip[:, :, 2 - b], 0, top)
+    dataset.FlushCache()
+    dataset = None
+
+    truth = {'size': size, 'epsg': epsg, 'geoTransform': geotransform,
+             'parcels': [np.round(facet, 2).tolist() for facet in facets], 'stickers': stickers}
+    with open(map_path.rsplit(".", 1)[0] + '_truth.json', 'w') as f:
+        json.dump(truth, f)
+
+    return truth
+
+
+# run a step of the pipeline (function stage of the script module_name) and add its time to the results, or the error
+# if it fails (e.g. a missing dependency), so that the other steps are still timed; the script is imported before
+# the timing starts; returns whether the step succeeded
+def time_stage(results, module_name, stage, *args, **kwargs):
+
+    print(f"Timing {stage}...")
+    try:
+        function = getattr(importlib.import_module(module_name), stage)
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        results[stage] = {'seconds': time.perf_counter() - start}
+    except Exception as error:
+        results[stage] = {'error': f"{type(error).__name__}: {error}"}
+        print(f"WARNING: {stage} failed - {results[stage]['error']}")
+
+    return 'seconds' in results[stage]
+
+
+# (ENTRY) time the pipeline on synthetic sketch maps of the given sizes (pixels per side) and add the run to the json file
+# results_path (one run per call: commit, date, machine, timings per size and step), then compare it with the previous run
+# work_dir: folder of the maps and outputs (None = a temporary folder, deleted at the end)
+# streaming_from: the boundaries of maps of this size or larger are extracted in the streaming mode
+# engine: postprocessing engine of generate_polygons, 'native' (without GRASS GIS) or 'grass'
+def run_benchmarks(sizes=(1000, 2000, 4000, 8000, 16000, 30000), results_path='benchmark_results.json', work_dir=None,
+                   seed=0, epsg='EPSG:32631', workers=1, streaming_from=8000, engine='native'):
+
+    run = {'commit': git_commit(), 'date': time.strftime("%Y-%m-%d %H:%M:%S"), 'python': platform.python_version(),
+           'machine': platform.platform(), 'cpus': os.cpu_count(), 'workers': workers, 'engine': engine, 'sizes': {}}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            run['sizes'][str(size)] = benchmark_pipeline(size, work_dir or tmp_dir, seed, epsg, workers, size >= streaming_from,
+                                                         engine)
+
+    runs = []
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            runs = json.load(f)['runs']
+
+    for size, stages in run['sizes'].items():
+        for stage, result in stages.items():
+            print(f"{size} pixels, {stage}: " + (f"{result['seconds']:.2f} s" if 'seconds' in result else result['error']))
+    if len(runs) > 0:
+        compare_runs(runs[-1], run)
+
+    runs.append(run)
+    with open(results_path, 'w') as f:
+        json.dump({'runs': runs}, f, indent=2)
+    print("Timings saved at ...", results_path)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -38,7 +38,11 @@ rebuild image from the labelled patches
 
 
 import cv2
-from patchify import patchify, unpatchify # divide image in smaller patches, and reconstruct images from small patches
+import hashlib # keys of the patch cache
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor # run the patches on several cores
+from contextlib import nullcontext
+from itertools import repeat
 import matplotlib.pyplot as plt # create interactive visualizations in Python
 import numpy as np # mathematical functions on multi-dimensional arrays and matrices
 
@@ -48,6 +52,7 @@ from skimage import color
 from skimage import feature
 from skimage import segmentation
 from skimage import measure
+from skimage import morphology
 
 
 # Local Maximum Definition: https://github.com/scikit-image/scikit-image/issues/3016#issuecomment-381087758
@@ -58,6 +63,183 @@ import time
 # starting time
 start = time.time()
 
+# filter parameters of the labelling, they are part of the keys of the patch cache
+BLUR_KERNEL = (5,5)
+CANNY_SIGMA = 0.3 # the smaller sigma, the more edges detected
+
+# a segmentation model with a single output channel gives the probability of a boundary (onnx backend)
+BOUNDARY_PROBABILITY = 0.5
+
+# geotiff output: size of the internal tiles of the in-memory mode, resampling of the overviews (masks keep 0 and 255)
+GEOTIFF_BLOCK = 256
+OVERVIEW_RESAMPLING = 'NEAREST'
+
+
+# add (bitwise or) the masks of window (i, j) of a grid (see label_patches), one per threshold, to the rasters of the grid, 
+# in place: the window starts at row top + i*step and column left + j*step of the rasters (see seam_windows), 
+# the parts of the window outside the rasters are dropped
+def add_window(grid, i, j, masks): 
+    
+    patches, all_added, top, left, step = grid
+    row, column = top + i*step, left + j*step
+    height, width = masks.shape[1], masks.shape[2]
+    for added, mask in zip(all_added, masks): 
+        row_0, column_0 = max(row, 0), max(column, 0)
+        row_1, column_1 = min(row + height, added.shape[0]), min(column + width, added.shape[1])
+        if row_1 > row_0 and column_1 > column_0: 
+            added[row_0:row_1, column_0:column_1] |= mask[row_0-row:row_1-row, column_0-column:column_1-column]
+
+
+# extract the boundaries with the whole raster in memory and return the merged boundaries of all patch grids,
+# one raster per threshold of the list thresholds
+# preprocess: 'patch' filters every patch on its own (see find_boundaries), 'raster' filters the whole raster once,
+# block by block (see preprocess_raster), and only runs the segmentation per patch
+# model, batch_size: segmentation model that labels the patches instead of find_boundaries (None = classical backend), 
+# see infer_patches
+# seam_width: None, or width of the strips along the seams of the patch grids that are labelled in addition to them 
+# (see seam_windows); the seam strips replace the shifted patch grids of a second pass at a fraction of its cost
+# executor: the workers shared by all patch grids, or None (serial), see create_executor
+def boundaries_in_memory(input_raster, patch_shape, thresholds, rgba, plot, offsets, executor, chunk_size, 
+                         preprocess, block_size, halo, marker_method, marker_param, cache_dir, model, batch_size, seam_width): 
+    
+    patch_size = patch_shape[0]
+    
+    # the seam strips start half a patch before the first seams
+    max_offset = max(offsets) if seam_width is None else max(max(offsets), patch_size//2)
+    
+    # read the image once and pad it for all the patch grids
+    padded, im_width, im_length = read_and_pad(input_raster, patch_size, rgba, max_offset)
+    
+    if preprocess == 'raster': 
+        print("Preprocessing the whole raster...")
+        image_2d, dt = preprocess_raster(padded, block_size, halo)
+    elif preprocess != 'patch': 
+        raise ValueError(f"Unknown preprocessing mode: {preprocess} (expected 'patch' or 'raster')")
+    
+    # windows of the patch grids (one per offset) and of the seam grids (one per direction of the seams), 
+    # in image coordinates (see seam_windows)
+    layouts = [(-offset, -offset, int(np.ceil((im_width + offset)/patch_size)), int(np.ceil((im_length + offset)/patch_size)), 
+                patch_size, patch_size) for offset in offsets]
+    if seam_width is not None: 
+        seams = seam_windows(patch_size, seam_width, im_width, im_length)
+        report_seams(seams, patch_size, im_width, im_length)
+        layouts += seams
+    
+    # one output raster per threshold, the masks of all grids are added into it as soon as a patch is labelled
+    all_added = [np.zeros((im_width, im_length), dtype=np.uint8) for _ in thresholds]
+    
+    print(f"Extracting the boundaries from the input raster ({len(layouts)} patch grids)...")
+    stats = {}
+    for top, left, n_rows, n_columns, height, width in layouts: 
+        # the patches are views on the padded image
+        window_args = (max_offset + top, max_offset + left, n_rows, n_columns, height, width, patch_size, patch_size)
+        if preprocess == 'raster': 
+            patches = (window_grid(image_2d, *window_args), window_grid(dt, *window_args))
+        else: 
+            patches = window_grid(padded, *window_args)
+        
+        # the smaller patches are brought together in the output rasters, in place (see add_window)
+        grid = (patches, all_added, top, left, patch_size)
+        if model is None: 
+            grid_stats = label_patches([grid], thresholds, plot, executor, chunk_size, 
+                                       marker_method, marker_param, cache_dir)
+        else: 
+            grid_stats = infer_patches([grid], model, batch_size)
+        for key in grid_stats: 
+            stats[key] = stats.get(key, 0) + grid_stats[key]
+    
+    if model is None: 
+        report_labelling(stats, marker_method)
+    else: 
+        report_inference(stats)
+    
+    #dilation so small gaps are closed - the dilation of the added masks is the sum of the dilated masks of the grids
+    kernel = np.ones((5,5),np.uint8)
+    for added in all_added: 
+        dilate_strips(added, kernel, patch_size)
+   
+    return all_added
+
+
+# add internal overviews to a geotiff opened for writing, overviews: list of decimation factors (e.g. [2, 4, 8]) or None
+# the overviews are compressed like the full resolution image
+def build_overviews(out_dataset, overviews, compression): 
+    
+    if not overviews: 
+        return
+    
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', compression)
+    out_dataset.BuildOverviews(OVERVIEW_RESAMPLING, list(overviews))
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+
+
+# key of a patch in the patch cache: hash of the patch content (bgr image, or gray image and distance transform)
+# and of all the parameters that change its masks
+def cache_key(patch, thresholds, marker_method, marker_param): 
+    
+    digest = hashlib.sha256()
+    for array in (patch if isinstance(patch, tuple) else (patch,)): 
+        digest.update(f"{array.shape}{array.dtype.str}".encode())
+        digest.update(np.ascontiguousarray(array).data)
+    digest.update(f"{thresholds}|{BLUR_KERNEL}|{CANNY_SIGMA}|{marker_method}|{marker_param}".encode())
+    
+    return digest.hexdigest()
+
+
+# workers of the labelling, created once per extraction and shared by all its patch grids and strips (see label_patches)
+# workers: number of workers (1 = serial, None = one per core); pool: 'process' or 'thread'
+# returns a context that gives the executor, or None for a serial labelling, and shuts the workers down at its end
+def create_executor(workers, pool): 
+    
+    if workers is None: 
+        workers = os.cpu_count()
+    if workers <= 1: 
+        return nullcontext()
+    
+    if pool == 'process': 
+        executor_class = ProcessPoolExecutor
+    elif pool == 'thread': 
+        executor_class = ThreadPoolExecutor
+    else: 
+        raise ValueError(f"Unknown pool type: {pool} (expected 'process' or 'thread')")
+    
+    print(f"Starting {workers} {pool} workers for the patches...")
+    return executor_class(max_workers=workers)
+
+
+# create an empty single band geotiff of im_width x im_length pixels for the boundaries, internally tiled (square tiles of 
+# block_size pixels, a multiple of 16) and compressed ('DEFLATE', 'LZW' or None), with the geotransform and the projection 
+# of the gdal dataset of the input raster, so that no tfw is needed and readers can fetch single tiles
+def create_geotiff(path, dataset, im_width, im_length, block_size, compression): 
+    
+    options = ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}', 'BIGTIFF=IF_SAFER']
+    if compression is not None: 
+        options.append(f'COMPRESS={compression}')
+    
+    out_dataset = gdal.GetDriverByName('GTiff').Create(path, im_length, im_width, 1, gdal.GDT_Byte, options=options)
+    if dataset.GetGeoTransform(can_return_null=True) is not None: 
+        out_dataset.SetGeoTransform(dataset.GetGeoTransform())
+    out_dataset.SetProjection(dataset.GetProjection())
+    
+    return out_dataset
+
+
+# dilate a raster in place, strip by strip (strips of strip_rows rows, at least half the kernel), so that only one strip is 
+# copied at a time; each strip is dilated together with the rows of its halo (half the kernel) above and below it, 
+# so the result is the one of cv2.dilate on the whole raster
+def dilate_strips(image, kernel, strip_rows): 
+    
+    halo = kernel.shape[0]//2
+    n_rows = image.shape[0]
+    
+    above = image[:0].copy() # rows above the strip, before their dilation
+    for top in range(0, n_rows, strip_rows): 
+        bottom = min(top + strip_rows, n_rows)
+        strip = np.concatenate((above, image[top : min(bottom + halo, n_rows)]))
+        n_above = above.shape[0]
+        above = image[max(bottom - halo, top) : bottom].copy()
+        image[top:bottom] = cv2.dilate(strip, kernel, iterations = 1)[n_above : n_above + bottom - top]
+
 
 # check if the file provided as input is of a given format
 def file_is_of_format(data_format, source_file): 
@@ -72,60 +254,54 @@ def file_is_of_format(data_format, source_file):
 # important parameters
 # thres: say which colors range of the image should be taken into account for labelling
 # sigma: influence the detection of edges
-# min_distance: say the minimum number of pixels separating peaks
-def find_boundaries(image, thres, i, j, plot): 
-
-    #blur the image to reduce the number of edges
-    blurred = cv2.blur(image, (5,5))
+# marker_method, marker_param: how the watershed markers are generated (see generate_markers)
+def find_boundaries(image, thres, i, j, plot, marker_method='peaks', marker_param=None): 
 
-    # convert the image to a gray colour scale
-    image_2d = cv2.cvtColor(blurred, cv2.COLOR_BGR2GRAY) 
-
-    # find edges in the image
-    # Edge detection identifies points where there are discontinuities (i.e. at which the image brightness changes sharply)
-    # https://dsp.stackexchange.com/questions/10736/which-sigma-to-use-for-edge-detection
-    edges = feature.canny(image_2d, sigma=0.3) # the smaller sigma, the more edges detected
-    #plt.imshow(edges)
-       
-    # ~edges make the edge to become the background, so that we can compute how far away we are from the edges
-    dt = ndimage.distance_transform_edt(~edges) 
-   
-    # find coordinates of the peaks
-    peak_idx = feature.peak_local_max(dt, min_distance=1, indices = False) # indices = false for watershed, indices = true for the distance transform
-    # kaspar min_distance = 10
-    # claudia_benin = 5
-    #peak_idx = feature.peak_local_max(dt, num_peaks=10, indices = False)
-   # peak_idx = feature.peak_local_max(dt,footprint=np.ones((50, 50)), indices = False)
-    markers = measure.label(peak_idx) # label connected regions based on the peaks, number of peaks = number of regions in the image
-
-    # Say which color range of the image should be labelled
-    watershed_mask = image_2d.copy()
-    #thres = 60 # do the segmentation for black regions in the image only (60)
-    watershed_mask[image_2d <= thres] = 255
-    watershed_mask[image_2d > thres] = 0
+    # blur, gray scale, edges and distance transform of the patch
+    image_2d, dt = preprocess_patch(image)
     
     # get labelled regions in the image
-    labels = segmentation.watershed(-dt, markers, mask=watershed_mask) # black regions as peaks
-    #print("[INFO] {} unique segments found".format(len(np.unique(labels)) - 1))
+    labels, n_markers, marker_seconds = segment_patch(image_2d, dt, thres, marker_method, marker_param)
           
     mask = labels.copy()
     mask[mask > 0] = 255
     
     if plot:
-        plt.figure()
-        plt.subplot(1, 4, 1)
-        plt.imshow(image_2d)
-        plt.subplot(1, 4, 2)
-        plt.imshow(dt)
-        plt.subplot(1, 4, 3)
-        plt.imshow(color.label2rgb(labels, image=image))
-        plt.subplot(1, 4, 4)
-        plt.imshow(mask)
-        plt.show()
+        plot_patch(image, image_2d, dt, labels, mask)
       
     return mask
 
 
+# markers of the watershed, computed from the distance transform of a patch
+# method (param, default):
+#   - 'peaks' (min_distance, 1): local maxima of the distance transform, at least min_distance pixels apart
+#   - 'hmaxima' (h, 1.0): regional maxima that are at least h pixels higher than their surroundings
+#   - 'edt_threshold' (distance, 2.0): connected regions that are more than distance pixels away from the edges
+# returns the labelled markers (one label per marker) and the number of markers
+def generate_markers(dt, method, param): 
+    
+    if method == 'peaks': 
+        min_distance = 1 if param is None else param
+        # find coordinates of the peaks
+        peak_idx = feature.peak_local_max(dt, min_distance=min_distance, indices = False) # indices = false for watershed, indices = true for the distance transform
+        # kaspar min_distance = 10
+        # claudia_benin = 5
+        #peak_idx = feature.peak_local_max(dt, num_peaks=10, indices = False)
+       # peak_idx = feature.peak_local_max(dt,footprint=np.ones((50, 50)), indices = False)
+    elif method == 'hmaxima': 
+        h = 1.0 if param is None else param
+        peak_idx = morphology.h_maxima(dt, h)
+    elif method == 'edt_threshold': 
+        distance = 2.0 if param is None else param
+        peak_idx = dt > distance
+    else: 
+        raise ValueError(f"Unknown marker method: {method} (expected 'peaks', 'hmaxima' or 'edt_threshold')")
+    
+    markers, n_markers = measure.label(peak_idx, return_num=True) # label connected regions based on the peaks, number of peaks = number of regions in the image
+    
+    return markers, n_markers
+
+
 # function that maps the parameters of the gdal geotransform to the lines of a tfw
 def generate_tfw(tiff_raster, info):
 
@@ -168,10 +344,377 @@ def generate_tfw(tiff_raster, info):
           f.write("%s\n" % item)
 
 
-# read and then resize the image slightly => Use Padding, not resizing!
-def read_and_resize(im_path, patch_shape, rgba): 
-    # get the size of the patches
-    patch_size = patch_shape[0]
+# offsets of the patch grids: the first grid starts at the upper-left corner of the image, 
+# the other ones are staggered by a fraction of the patch size (2 passes = 0 and half a patch)
+def grid_offsets(patch_size, n_passes): 
+    return [int(k*patch_size/n_passes) for k in range(n_passes)]
+
+
+# number of rows and columns of a grid of patches, or of the grids of a tuple of grids (see patch_at)
+def grid_shape(patches): 
+    
+    if isinstance(patches, tuple): 
+        patches = patches[0]
+    
+    return patches.shape[0], patches.shape[1]
+
+
+# label the patches of one or several patch grids with a segmentation model (onnx backend) and add the results to 
+# the rasters of each grid (see label_patches, the rasters have a single threshold)
+# model: see load_model; batch_size: number of patches given to the model at once
+# the next batch is put together in a background thread while the model runs on the current one
+# returns statistics of the inference: number of patches, of batches, and the time spent in the model
+def infer_patches(grids, model, batch_size): 
+    
+    # the patches of a batch come from the same grid, so that they have the same shape
+    batches = []
+    for g, grid in enumerate(grids): 
+        n_rows, n_columns = grid_shape(grid[0])
+        jobs = [(g, i, j) for i in range(n_rows) for j in range(n_columns)]
+        batches += [jobs[k : k + batch_size] for k in range(0, len(jobs), batch_size)]
+    stats = {'patches': sum(len(batch_jobs) for batch_jobs in batches), 'batches': len(batches), 'inference_seconds': 0.0}
+    if len(batches) == 0: 
+        return stats
+    
+    with ThreadPoolExecutor(max_workers=1) as prefetcher: 
+        next_batch = prefetcher.submit(prepare_batch, [grids[g][0][i,j] for g, i, j in batches[0]], model['layout'], 
+                                       model['size'])
+        for k, batch_jobs in enumerate(batches): 
+            batch = next_batch.result()
+            if k + 1 < len(batches): 
+                next_batch = prefetcher.submit(prepare_batch, [grids[g][0][i,j] for g, i, j in batches[k+1]], model['layout'], 
+                                               model['size'])
+            
+            # the model releases the gil, so the next batch is put together meanwhile
+            # the masks of windows padded to a fixed input size are cropped back to the windows
+            height, width = grids[batch_jobs[0][0]][0].shape[2:4]
+            top, left = model_window(model['size'], (height, width))
+            start_inference = time.perf_counter()
+            batch_masks = predict_masks(model, batch, model['size'] or (height, width))[:, top:top + height, left:left + width]
+            stats['inference_seconds'] += time.perf_counter() - start_inference
+            
+            for (g, i, j), mask in zip(batch_jobs, batch_masks): 
+                add_window(grids[g], i, j, mask[np.newaxis])
+    
+    return stats
+
+
+# number of pixel values at or below the threshold in a patch (0 for a blank patch)
+# for a bgr patch all channels are counted, for a preprocessed patch only the gray image
+def ink_density(patch, thres): 
+    
+    if isinstance(patch, tuple): 
+        patch = patch[0]
+    
+    return np.count_nonzero(patch <= thres)
+
+
+# label a single patch for one or several thresholds: the patch is either a bgr image, or the (gray image, distance transform) 
+# pair of a preprocessed raster (see preprocess_raster). Filters and markers do not depend on the threshold, they are computed 
+# once, and only the watershed runs per threshold.
+# Returns the masks (one per threshold), the number of markers and the time spent on the markers
+def label_patch(patch, thresholds, i, j, plot, marker_method, marker_param): 
+    
+    if isinstance(patch, tuple): 
+        image_2d, dt = patch
+    else: 
+        image_2d, dt = preprocess_patch(patch)
+    
+    start_markers = time.perf_counter()
+    markers, n_markers = generate_markers(dt, marker_method, marker_param)
+    marker_seconds = time.perf_counter() - start_markers
+    
+    masks = np.zeros((len(thresholds),) + image_2d.shape, dtype=np.uint8)
+    minimum = image_2d.min()
+    for k, thres in enumerate(thresholds): 
+        # no pixel at or below the threshold: the mask is empty
+        if minimum > thres: 
+            continue
+        labels = watershed_patch(image_2d, dt, markers, thres)
+        masks[k][labels > 0] = 255
+    
+        if plot: 
+            plot_patch(image_2d if isinstance(patch, tuple) else patch, image_2d, dt, labels, masks[k])
+    
+    return masks, n_markers, marker_seconds
+
+
+# label the patches of one or several patch grids and add the results to the rasters of each grid, patch by patch
+# grids: list of (patches, all_added, top, left, step) tuples, with patches as returned by patch_grid (or window_grid), or 
+# a (gray patches, distance transform patches) pair for a preprocessed raster; the masks of patch (i, j) are added to the 
+# rasters of all_added (one per threshold) at row top + i*step and column left + j*step (see add_window)
+# thresholds: list of thresholds, the patches are labelled once for all of them (see label_patch)
+# executor: the workers of the extraction (see create_executor), or None to label the patches serially
+# chunk_size: number of patches sent to a process worker at once
+# marker_method, marker_param: see generate_markers
+# cache_dir: folder of the patch cache (None = no cache), masks of patches labelled before are read from there
+# returns statistics of the labelling: number of patches, of blank patches that were skipped, of patches read from 
+# the cache, of markers, and the time spent on the markers (summed over all workers)
+def label_patches(grids, thresholds, plot, executor, chunk_size, marker_method, marker_param, cache_dir): 
+
+    # (grid, row, column) of every patch, so that the patches of all grids share the same workers
+    jobs = [(g, i, j) for g, grid in enumerate(grids)
+                      for i in range(grid_shape(grid[0])[0]) 
+                      for j in range(grid_shape(grid[0])[1])]
+    n_patches = len(jobs)
+    
+    # blank patches (no pixel at or below the thresholds) always give empty masks: blur and gray scale conversion 
+    # are weighted means, so none of their pixels can reach the thresholds, and there is nothing to add
+    densities = {}
+    for g, i, j in jobs: 
+        density = ink_density(patch_at(grids[g][0], i, j), max(thresholds))
+        if density > 0: 
+            densities[(g, i, j)] = density
+    stats = {'patches': n_patches, 'blank': n_patches - len(densities), 'cached': 0, 'markers': 0, 'marker_seconds': 0.0}
+    
+    # patches with the same content and parameters as in a previous run are read from the cache
+    keys = {}
+    if cache_dir is not None: 
+        for g, i, j in list(densities): 
+            key = cache_key(patch_at(grids[g][0], i, j), thresholds, marker_method, marker_param)
+            cached_mask = load_cached_mask(cache_dir, key)
+            if cached_mask is None: 
+                keys[(g, i, j)] = key
+            else: 
+                add_window(grids[g], i, j, cached_mask.reshape(len(thresholds), -1, cached_mask.shape[-1]))
+                del densities[(g, i, j)]
+                stats['cached'] += 1
+    
+    # the patches with the most ink take the longest, start with them so that the workers end at the same time
+    jobs = sorted(densities, key=densities.get, reverse=True)
+    
+    # plots can only be shown from the main process
+    if executor is None or plot or len(jobs) == 0:
+        for g, i, j in jobs: 
+            current_mask, n_markers, marker_seconds = label_patch(patch_at(grids[g][0], i, j), thresholds, i, j, plot, 
+                                                                  marker_method, marker_param)
+            add_window(grids[g], i, j, current_mask)
+            stats['markers'] += n_markers
+            stats['marker_seconds'] += marker_seconds
+            if cache_dir is not None: 
+                save_cached_mask(cache_dir, keys[(g, i, j)], current_mask)
+        return stats
+    
+    print(f"Labelling {len(jobs)} patches with the workers...")
+    single_patches = (patch_at(grids[g][0], i, j) for g, i, j in jobs)
+    rows = (i for g, i, j in jobs)
+    columns = (j for g, i, j in jobs)
+    # map returns the masks in the order of the jobs, so each one can be added at its place
+    results = executor.map(label_patch, single_patches, repeat(thresholds), rows, columns, repeat(False), 
+                           repeat(marker_method), repeat(marker_param), chunksize=chunk_size)
+    for (g, i, j), (current_mask, n_markers, marker_seconds) in zip(jobs, results): 
+        add_window(grids[g], i, j, current_mask)
+        stats['markers'] += n_markers
+        stats['marker_seconds'] += marker_seconds
+        if cache_dir is not None: 
+            save_cached_mask(cache_dir, keys[(g, i, j)], current_mask)
+    
+    return stats
+
+
+# read the mask of a patch from the cache, or None if it is not there
+def load_cached_mask(cache_dir, key): 
+    
+    path = os.path.join(cache_dir, key[:2], key + '.png')
+    if not os.path.exists(path): 
+        return None
+    
+    mask = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if mask is not None: 
+        os.utime(path) # most recently used
+    
+    return mask
+
+
+# load a segmentation model exported to onnx (e.g. the unet or the segformer model of the project) to run it on the cpu
+# returns the onnx runtime session, the name of its input, the layout of its input and output tensors: 
+# 'nhwc' (channels last, as exported from keras) or 'nchw' (channels first, as exported from pytorch), and the size 
+# (height, width) of its input if it is fixed (e.g. a keras unet exported for 256 x 256 patches), None if it is dynamic
+def load_model(model_path): 
+    
+    # only needed for the onnx backend
+    import onnxruntime
+    
+    session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    model_input = session.get_inputs()[0]
+    layout = 'nhwc' if model_input.shape[-1] == 3 else 'nchw'
+    size = tuple(model_input.shape[1:3] if layout == 'nhwc' else model_input.shape[2:4])
+    size = size if all(isinstance(d, int) for d in size) else None # dynamic dimensions are named
+    print(f"Model loaded from ... {model_path} (input {model_input.name}, {layout}, size {size or 'dynamic'})")
+    
+    return {'session': session, 'input': model_input.name, 'layout': layout, 'size': size}
+
+
+# position (top, left) of a window of the given shape (height, width) in the input of a model (see load_model): the window 
+# is centered in a fixed input size, and is the whole input of a model with a dynamic size (size None)
+def model_window(size, shape): 
+    
+    if size is None: 
+        return 0, 0
+    if shape[0] > size[0] or shape[1] > size[1]: 
+        raise ValueError(f"The windows of {shape[0]} x {shape[1]} pixels do not fit the input of the model ({size[0]} x {size[1]})")
+    
+    return (size[0] - shape[0])//2, (size[1] - shape[1])//2
+
+
+# patch (i, j) of a grid of patches, or of each grid of a tuple of grids
+def patch_at(patches, i, j): 
+    
+    if isinstance(patches, tuple): 
+        return tuple(p[i,j] for p in patches)
+    
+    return patches[i,j]
+
+
+# patches of the grid shifted by offset pixels, as a strided view on the padded image (no copy)
+# the result has the shape (rows, columns, patch_size, patch_size, channels), or (rows, columns, patch_size, patch_size)
+# for a single band raster; only the patches that overlap the image are part of the grid
+def patch_grid(padded, patch_size, offset, max_offset, im_width, im_length): 
+    
+    n_rows = int(np.ceil((im_width + offset)/patch_size))
+    n_columns = int(np.ceil((im_length + offset)/patch_size))
+    
+    # the padded image has max_offset pixels on the top and on the left
+    return window_grid(padded, max_offset - offset, max_offset - offset, n_rows, n_columns, 
+                       patch_size, patch_size, patch_size, patch_size)
+
+
+# show the steps of the labelling of a patch
+def plot_patch(image, image_2d, dt, labels, mask): 
+    
+    plt.figure()
+    plt.subplot(1, 4, 1)
+    plt.imshow(image_2d)
+    plt.subplot(1, 4, 2)
+    plt.imshow(dt)
+    plt.subplot(1, 4, 3)
+    plt.imshow(color.label2rgb(labels, image=image))
+    plt.subplot(1, 4, 4)
+    plt.imshow(mask)
+    plt.show()
+
+
+# boundary masks of a batch of patches predicted by a segmentation model (see load_model)
+# outputs smaller than the patches (e.g. a quarter of their size for segformer) are resized to the patch shape (height, width); 
+# a single output channel is the probability of a boundary, with several channels the most likely class is kept, the class 1 
+# being the boundaries
+def predict_masks(model, batch, shape): 
+    
+    scores = model['session'].run(None, {model['input']: batch})[0]
+    if model['layout'] == 'nchw': 
+        scores = scores.transpose(0, 2, 3, 1)
+    
+    height, width = shape
+    masks = np.zeros((scores.shape[0], height, width), dtype=np.uint8)
+    for k, patch_scores in enumerate(scores): 
+        if patch_scores.shape[0] != height or patch_scores.shape[1] != width: 
+            patch_scores = cv2.resize(patch_scores, (width, height), interpolation=cv2.INTER_LINEAR)
+            patch_scores = patch_scores.reshape(height, width, -1) # cv2 drops a single channel
+        if patch_scores.shape[2] == 1: 
+            masks[k][patch_scores[:,:,0] > BOUNDARY_PROBABILITY] = 255
+        else: 
+            masks[k][np.argmax(patch_scores, axis=2) == 1] = 255
+    
+    return masks
+
+
+# input tensor of a segmentation model for a list of bgr patches: rgb values between 0 and 1, in the layout of the model
+# (see load_model); any further normalization is expected to be part of the exported model
+# size: input size (height, width) of a model with a fixed input, the smaller patches (e.g. the seam windows) are padded
+# with white paper around them, see model_window
+def prepare_batch(patches, layout, size=None): 
+    
+    batch = np.stack(patches)
+    if size is not None and batch.shape[1:3] != size: 
+        top, left = model_window(size, batch.shape[1:3])
+        batch = np.pad(batch, ((0, 0), (top, size[0] - batch.shape[1] - top), (left, size[1] - batch.shape[2] - left), (0, 0)), 
+                       constant_values=255)
+    batch = batch[..., ::-1].astype(np.float32)/255
+    if layout == 'nchw': 
+        batch = batch.transpose(0, 3, 1, 2)
+    
+    return np.ascontiguousarray(batch)
+
+
+# filters of find_boundaries that do not depend on the threshold: blur, gray scale, edges and distance transform
+# image is a bgr patch (or a larger block of the raster, see preprocess_raster)
+def preprocess_patch(image): 
+
+    #blur the image to reduce the number of edges
+    blurred = cv2.blur(image, BLUR_KERNEL)
+
+    # convert the image to a gray colour scale
+    image_2d = cv2.cvtColor(blurred, cv2.COLOR_BGR2GRAY) 
+
+    # find edges in the image
+    # Edge detection identifies points where there are discontinuities (i.e. at which the image brightness changes sharply)
+    # https://dsp.stackexchange.com/questions/10736/which-sigma-to-use-for-edge-detection
+    edges = feature.canny(image_2d, sigma=CANNY_SIGMA) # the smaller sigma, the more edges detected
+    #plt.imshow(edges)
+       
+    # ~edges make the edge to become the background, so that we can compute how far away we are from the edges
+    dt = ndimage.distance_transform_edt(~edges) 
+    
+    return image_2d, dt
+
+
+# run the filters of preprocess_patch once over the whole (padded) raster, block by block
+# each block is filtered with a halo of pixels around it, so blur and edges are the same as for the whole raster;
+# the distance transform is exact up to halo pixels away from the edges (patches do not cut it anymore)
+# returns the gray image (uint8) and the distance transform (float32), both with the shape of the raster
+def preprocess_raster(padded, block_size, halo): 
+    
+    n_rows, n_columns = padded.shape[0], padded.shape[1]
+    image_2d = np.empty((n_rows, n_columns), dtype=np.uint8)
+    dt = np.empty((n_rows, n_columns), dtype=np.float32)
+    
+    for row in range(0, n_rows, block_size): 
+        for column in range(0, n_columns, block_size): 
+            # block with its halo, clipped to the raster
+            top, left = max(row - halo, 0), max(column - halo, 0)
+            bottom, right = min(row + block_size + halo, n_rows), min(column + block_size + halo, n_columns)
+            
+            # same filters as in preprocess_patch
+            blurred = cv2.blur(padded[top:bottom, left:right], BLUR_KERNEL)
+            block_2d = cv2.cvtColor(blurred, cv2.COLOR_BGR2GRAY) 
+            edges = feature.canny(block_2d, sigma=CANNY_SIGMA)
+            # exact euclidean distance transform, as ndimage.distance_transform_edt but in float32 and faster on large blocks
+            block_dt = cv2.distanceTransform((~edges).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            
+            # keep the block without its halo
+            row_1, column_1 = min(row + block_size, n_rows), min(column + block_size, n_columns)
+            image_2d[row:row_1, column:column_1] = block_2d[row-top:row_1-top, column-left:column_1-left]
+            dt[row:row_1, column:column_1] = block_dt[row-top:row_1-top, column-left:column_1-left]
+    
+    return image_2d, dt
+
+
+# remove the least recently used masks from the cache until it is not larger than max_bytes
+def prune_cache(cache_dir, max_bytes): 
+    
+    entries = []
+    for root, dirs, files in os.walk(cache_dir): 
+        for name in files: 
+            path = os.path.join(root, name)
+            status = os.stat(path)
+            entries.append((status.st_mtime, status.st_size, path))
+    
+    total_bytes = sum(size for mtime, size, path in entries)
+    n_removed = 0
+    for mtime, size, path in sorted(entries): 
+        if total_bytes <= max_bytes: 
+            break
+        os.remove(path)
+        total_bytes -= size
+        n_removed += 1
+    
+    print(f"Patch cache: {len(entries) - n_removed} masks, {total_bytes/2**20:.1f} MB ({n_removed} removed)")
+
+
+# read the image and pad it once for all patch grids => Use Padding, not resizing!
+# white padding of max_offset pixels on the top and on the left (for the shifted grids) 
+# and of one patch on the bottom and on the right, so that none of the image is lost
+def read_and_pad(im_path, patch_size, rgba, max_offset): 
     
     if (rgba): 
         rgba_image = cv2.imread(im_path)
@@ -179,92 +722,367 @@ def read_and_resize(im_path, patch_shape, rgba):
     else: 
         image = cv2.imread(im_path)
         
-        
     raster_w = image.shape[0]     
     raster_l = image.shape[1]
     
-    # create white padding on the bottom and the right so that none of the image is lost
-    padded = cv2.copyMakeBorder(image, 0, patch_size, 0, patch_size, cv2.BORDER_CONSTANT, value=(255,255,255))
-    width = padded.shape[0]
-    height = padded.shape[1]
-    cropped_1 = padded[0:int(np.floor(width/patch_size)*patch_size), 0:int(np.floor(height/patch_size)*patch_size)]
+    padded = cv2.copyMakeBorder(image, max_offset, patch_size, max_offset, patch_size, cv2.BORDER_CONSTANT, value=(255,255,255))
+    
+    return padded, raster_w, raster_l
+
+# read the windows of the patch rows of the list keys, (grid, patch row, offset) triples (see strip_patch_rows), 
+# one array of shape (1, columns, patch_size, patch_size, 3) per patch row (see read_window)
+def read_patch_rows(dataset, keys, patch_size): 
     
-    #create another image with a different padding so patches are positioned differently
-    padded_2 = cv2.copyMakeBorder(image, int(patch_size/2), patch_size, int(patch_size/2), patch_size, cv2.BORDER_CONSTANT, value=(255,255,255))
-    width_2 = padded_2.shape[0]
-    height_2 = padded_2.shape[1]
-    cropped_2 = padded_2[0:int(np.floor(width_2/patch_size)*patch_size), 0:int(np.floor(height_2/patch_size)*patch_size)]
+    all_patches = []
+    for g, i, offset in keys: 
+        n_columns = int(np.ceil((dataset.RasterXSize + offset)/patch_size))
+        patches = np.empty((1, n_columns, patch_size, patch_size, 3), dtype=np.uint8)
+        for j in range(n_columns): 
+            patches[0,j] = read_window(dataset, i*patch_size - offset, j*patch_size - offset, patch_size)
+        all_patches.append(patches)
     
-    return cropped_1, cropped_2, raster_w, raster_l
+    return all_patches
 
-# (ENTRY) function to extract boundaries from a raster image - it reuses the functions defined above
-def extract_boundaries(input_raster, boundaries, patch_shape, current_threshold, rgba, tfw, plot): 
+
+# read a square window of a gdal dataset as a bgr image (channel order of cv2.imread)
+# the parts of the window outside the raster are white, as with the padding of read_and_pad
+def read_window(dataset, row, column, size): 
     
-    print("The input raster is ...", input_raster)
-    # read and resize image slightly
-    cropped_image_1, cropped_image_2, im_width, im_length = read_and_resize(input_raster, patch_shape, rgba)
+    window = np.full((size, size, 3), 255, dtype=np.uint8)
+    
+    # clip the window to the extent of the raster
+    row_0, col_0 = max(row, 0), max(column, 0)
+    row_1, col_1 = min(row + size, dataset.RasterYSize), min(column + size, dataset.RasterXSize)
+    if row_1 <= row_0 or col_1 <= col_0: 
+        return window
     
-    ############
-    # convert the image to a numpy array
-    cropped_sketch = np.asarray(cropped_image_1)
+    # only the first three bands are read (the alpha band, if any, is dropped like in cv2.imread)
+    n_bands = min(dataset.RasterCount, 3)
+    for b in range(n_bands): 
+        band = dataset.GetRasterBand(b + 1).ReadAsArray(col_0, row_0, col_1 - col_0, row_1 - row_0)
+        if n_bands == 1: 
+            window[row_0-row:row_1-row, col_0-column:col_1-column, :] = band[:, :, np.newaxis]
+        else: 
+            # gdal bands are RGB, cv2 expects BGR
+            window[row_0-row:row_1-row, col_0-column:col_1-column, 2 - b] = band
     
-    # Generate patches, code adapted from https://github.com/bnsreenu/python_for_microscopists/blob/master/Tips_Tricks_5_extracting_patches_from_large_images_and_masks_for_semantic_segm.py
-    patches = patchify(cropped_sketch, (patch_shape[0], patch_shape[1], patch_shape[2]), step=patch_shape[0])  #Step=256 for 256 patches means no overlap
+    return window
 
-    masks = np.empty((patches.shape[0], 
-                     patches.shape[1],
-                     patches.shape[3],
-                     patches.shape[4]),
-                     dtype=np.uint8)
-   
-    print("Extracting the boundaries from the input raster...")
-    # extract boundaries from patches and bring the smaller patches together
-    for i in range(patches.shape[0]):  
-        for j in range(patches.shape[1]):
-              single_patch_img = patches[i,j,0,:,:,:] 
-              current_mask = find_boundaries(single_patch_img, current_threshold, i, j, plot)
-              masks[i,j,:,:] = current_mask
-  
-    reconstructed_1 = unpatchify(masks, (cropped_sketch.shape[0], cropped_sketch.shape[1]))
-    reconstructed_1 = reconstructed_1[0 : im_width, 0 : im_length]
-
-    
-    # do it a second time with different patches
-    
-    cropped_sketch_2 = np.asarray(cropped_image_2)
-    
-    patches_2 = patchify(cropped_sketch_2, (patch_shape[0], patch_shape[1], patch_shape[2]), step=patch_shape[0])  
-    masks_2 = np.empty((patches_2.shape[0], 
-                     patches_2.shape[1],
-                     patches_2.shape[3],
-                     patches_2.shape[4]),
-                     dtype=np.uint8)
+
+# print the statistics returned by infer_patches
+def report_inference(stats): 
+    
+    print(f"Model inference: {stats['patches']} patches in {stats['batches']} batches, {stats['inference_seconds']:.2f} s")
+
+
+# print the statistics returned by label_patches
+def report_labelling(stats, marker_method): 
+    
+    print(f"Blank patches skipped: {stats['blank']} of {stats['patches']}; patches read from the cache: {stats['cached']}")
+    print(f"Markers ({marker_method}): {stats['markers']} in {stats['patches'] - stats['blank'] - stats['cached']} patches, "
+          f"{stats['marker_seconds']:.2f} s")
+
+
+# compare the pixels of the seam windows (see seam_windows) with the ones of the patch grid shifted by half a patch 
+# that they replace (the cost of the labelling grows with the number of pixels)
+def report_seams(seams, patch_size, im_width, im_length): 
+    
+    seam_pixels = sum(n_rows*n_columns*height*width for top, left, n_rows, n_columns, height, width in seams)
+    grid_pixels = int(np.ceil((im_width + patch_size//2)/patch_size))*int(np.ceil((im_length + patch_size//2)/patch_size))*patch_size**2
+    print(f"Seam pass: {seam_pixels/1e6:.1f} Mpixels instead of {grid_pixels/1e6:.1f} Mpixels for a shifted patch grid "
+          f"({100*(1 - seam_pixels/grid_pixels):.0f} % less)")
+
+
+# write the masks of a patch to the cache (as a png with the masks of all thresholds on top of each other,
+# through a temporary file so that readers never see half a file)
+def save_cached_mask(cache_dir, key, mask): 
+    
+    folder = os.path.join(cache_dir, key[:2])
+    os.makedirs(folder, exist_ok=True)
+    
+    tmp_path = os.path.join(folder, f"{key}.{os.getpid()}.tmp.png")
+    cv2.imwrite(tmp_path, mask.reshape(-1, mask.shape[-1]))
+    os.replace(tmp_path, os.path.join(folder, key + '.png'))
+
+
+# save the boundaries of the in-memory mode as a tiled and compressed geotiff, georeferenced like the input raster
+# (see create_geotiff), with optional overviews (see build_overviews)
+def save_geotiff(path, added, input_raster, compression, overviews): 
+    
+    dataset = gdal.Open(input_raster)
+    out_dataset = create_geotiff(path, dataset, added.shape[0], added.shape[1], GEOTIFF_BLOCK, compression)
+    out_dataset.GetRasterBand(1).WriteArray(added, 0, 0)
+    build_overviews(out_dataset, overviews, compression)
+    out_dataset.FlushCache()
+    out_dataset = None
+    dataset = None
+
+
+# windows along the seams of the patch grid that starts at the upper-left corner of the image, in two grids: 
+#   - windows of patch_size x seam_width pixels centered on the vertical seams (columns patch_size, 2*patch_size...)
+#   - windows of seam_width x patch_size pixels centered on the horizontal seams (rows patch_size, 2*patch_size...)
+# the windows of both grids are centered on the crossings of the seams along the seams, so that none of them is cut 
+# at a seam of the patch grid or at a seam of the other grid
+# returns, per grid, the position of its first window in the image (top, left), its number of rows and columns of windows 
+# and the size of the windows (height, width); the windows of a grid are patch_size pixels apart
+def seam_windows(patch_size, seam_width, im_width, im_length): 
+    
+    half_patch, half_seam = patch_size//2, seam_width//2
+    n_rows = int(np.ceil(im_width/patch_size))
+    n_columns = int(np.ceil(im_length/patch_size))
+    
+    vertical = (-half_patch, patch_size - half_seam, int(np.ceil((im_width + half_patch)/patch_size)), n_columns - 1, 
+                patch_size, seam_width)
+    horizontal = (patch_size - half_seam, -half_patch, n_rows - 1, int(np.ceil((im_length + half_patch)/patch_size)), 
+                  seam_width, patch_size)
+    
+    return [vertical, horizontal]
+
+
+# label the regions of a patch from its gray image and distance transform (see preprocess_patch)
+# thres: say which colors range of the image should be taken into account for labelling
+# returns the labels, the number of markers and the time spent on the markers (see generate_markers)
+def segment_patch(image_2d, dt, thres, marker_method, marker_param): 
    
-    print("Extracting the boundaries from the input raster...")
-    # extract boundaries from patches and bring the smaller patches together
-    for i in range(patches_2.shape[0]):  
-        for j in range(patches_2.shape[1]):
-              single_patch_img = patches_2[i,j,0,:,:,:] 
-              current_mask = find_boundaries(single_patch_img, current_threshold, i, j, plot)
-              masks_2[i,j,:,:] = current_mask
-  
-    reconstructed_2 = unpatchify(masks_2, (cropped_sketch_2.shape[0], cropped_sketch_2.shape[1]))
-    reconstructed_2 = reconstructed_2[int(patch_shape[0]/2) : im_width+int(patch_shape[0]/2), int(patch_shape[0]/2) : im_length+int(patch_shape[0]/2)]
-    
-    #dilation so small gaps are closed
+    start_markers = time.perf_counter()
+    markers, n_markers = generate_markers(dt, marker_method, marker_param)
+    marker_seconds = time.perf_counter() - start_markers
+    
+    labels = watershed_patch(image_2d, dt, markers, thres)
+    
+    return labels, n_markers, marker_seconds
+
+
+# extract the boundaries strip by strip, reading patch windows through gdal and writing each finished strip 
+# into a tiled geotiff (one geotiff of the list all_boundaries per threshold of the list thresholds, see create_geotiff 
+# and build_overviews). Only a few rows of patches are held in memory, whatever the size of the raster.
+# The windows of the next strip are read in a background thread while the current one is labelled.
+# The result is the same as the one of extract_boundaries (same patch grids, same dilation and merge)
+# executor: the workers shared by all strips, or None (serial), see create_executor
+def stream_boundaries(input_raster, all_boundaries, patch_shape, thresholds, offsets, executor, chunk_size, 
+                      marker_method, marker_param, cache_dir, model, batch_size, compression, overviews): 
+    
+    patch_size = patch_shape[0]
+    halo = 2 # the 5x5 dilation needs two more rows on both sides of a strip
     kernel = np.ones((5,5),np.uint8)
-    dilation_1 = cv2.dilate(reconstructed_1,kernel,iterations = 1)
-    dilation_2 = cv2.dilate(reconstructed_2,kernel,iterations = 1)   
     
-    # add the two rasters
-    added = cv2.bitwise_or(dilation_1, dilation_2)
-   
-    #save the reconstructed image
-    print("Saving the boundaries at ...", boundaries)
-    cv2.imwrite(boundaries, added)
+    dataset = gdal.Open(input_raster)
+    im_width, im_length = dataset.RasterYSize, dataset.RasterXSize
+    
+    # tiled output with the georeference of the input raster
+    block_size = patch_size if patch_size % 16 == 0 else GEOTIFF_BLOCK # gdal needs blocks that are multiples of 16
+    out_datasets = [create_geotiff(boundaries, dataset, im_width, im_length, block_size, compression) 
+                    for boundaries in all_boundaries]
+    
+    # masks of the patch rows computed so far: (grid, patch row) -> strip of shape (thresholds, patch_size, im_length)
+    # the patches are added into their strip as soon as they are labelled
+    strips = {}
+    stats = {}
+    
+    n_strips = int(np.ceil(im_width/patch_size))
+    scheduled = set()
+    with ThreadPoolExecutor(max_workers=1) as reader: 
+        next_keys = strip_patch_rows(0, patch_size, halo, offsets, im_width, scheduled)
+        next_patches = reader.submit(read_patch_rows, dataset, next_keys, patch_size)
+        for k in range(n_strips): 
+            # rows of the raster needed for strip k, halo included
+            top = max(k*patch_size - halo, 0)
+            bottom = min((k+1)*patch_size + halo, im_width)
+            
+            # the patch rows of both grids that are needed and not computed yet were read in the background,
+            # the ones of the next strip are read while these are labelled (gdal releases the gil while it decodes)
+            keys, all_patches = next_keys, next_patches.result()
+            if k + 1 < n_strips: 
+                next_keys = strip_patch_rows(k + 1, patch_size, halo, offsets, im_width, scheduled)
+                next_patches = reader.submit(read_patch_rows, dataset, next_keys, patch_size)
+            
+            grids = []
+            for patches, (g, i, offset) in zip(all_patches, keys): 
+                strips[(g, i)] = np.zeros((len(thresholds), patch_size, im_length), dtype=np.uint8)
+                grids.append((patches, strips[(g, i)], 0, -offset, patch_size))
+            if model is None: 
+                strip_stats = label_patches(grids, thresholds, False, executor, chunk_size, 
+                                            marker_method, marker_param, cache_dir)
+            else: 
+                strip_stats = infer_patches(grids, model, batch_size)
+            for key in strip_stats: 
+                stats[key] = stats.get(key, 0) + strip_stats[key]
+            
+            for t, out_dataset in enumerate(out_datasets): 
+                # reconstruct and add the grids on the rows of the strip, in place, then dilate them once 
+                # (the dilation of the added grids is the sum of the dilated grids)
+                added = np.zeros((bottom - top, im_length), dtype=np.uint8)
+                for g, i, offset in strip_patch_rows(k, patch_size, halo, offsets, im_width, set()): 
+                    strip_top = i*patch_size - offset
+                    row_0, row_1 = max(strip_top, top), min(strip_top + patch_size, bottom)
+                    added[row_0-top:row_1-top] |= strips[(g, i)][t, row_0-strip_top:row_1-strip_top]
+                added = cv2.dilate(added, kernel, iterations = 1)
+                
+                # write the strip without its halo
+                out_dataset.GetRasterBand(1).WriteArray(added[k*patch_size - top : min((k+1)*patch_size, im_width) - top], 
+                                                        0, k*patch_size)
+            
+            # drop the patch rows that the next strip does not need anymore
+            next_top = (k+1)*patch_size - halo
+            for g, i in list(strips): 
+                if i*patch_size - offsets[g] + patch_size <= next_top: 
+                    del strips[(g, i)]
+    
+    for out_dataset in out_datasets: 
+        build_overviews(out_dataset, overviews, compression)
+        out_dataset.FlushCache()
+    out_datasets = None
+    dataset = None
+    
+    if model is None: 
+        report_labelling(stats, marker_method)
+    else: 
+        report_inference(stats)
+
+
+# patch rows of the grids (one per offset) that strip k needs, halo rows included on both sides: (grid, patch row, offset) 
+# triples, without the ones of the set scheduled, that are needed by an earlier strip; the new ones are added to it
+def strip_patch_rows(k, patch_size, halo, offsets, im_width, scheduled): 
+    
+    top = max(k*patch_size - halo, 0)
+    bottom = min((k+1)*patch_size + halo, im_width)
+    keys = [(g, i, offset) for g, offset in enumerate(offsets) 
+                           for i in range((top + offset)//patch_size, (bottom - 1 + offset)//patch_size + 1)
+                           if (g, i) not in scheduled]
+    scheduled.update((g, i) for g, i, offset in keys)
+    
+    return keys
+
+
+# path of the boundaries of one threshold of a sweep: the threshold is added to the file name (boundaries_60.tif)
+def threshold_path(boundaries, thres): 
+    
+    name, extension = boundaries.rsplit(".", 1)
+    
+    return f"{name}_{thres}.{extension}"
+
+
+# watershed of a patch from its markers, restricted to the pixels at or below the threshold
+def watershed_patch(image_2d, dt, markers, thres): 
+
+    # Say which color range of the image should be labelled
+    watershed_mask = image_2d.copy()
+    #thres = 60 # do the segmentation for black regions in the image only (60)
+    watershed_mask[image_2d <= thres] = 255
+    watershed_mask[image_2d > thres] = 0
+    
+    # get labelled regions in the image
+    labels = segmentation.watershed(-dt, markers, mask=watershed_mask) # black regions as peaks
+    #print("[INFO] {} unique segments found".format(len(np.unique(labels)) - 1))
+    
+    return labels
+
+
+# grid of windows of height x width pixels on the padded image, as a strided view (no copy): window (i, j) starts at row 
+# top + i*row_step and column left + j*column_step of the padded image
+def window_grid(padded, top, left, n_rows, n_columns, height, width, row_step, column_step): 
+    
+    start = padded[top:, left:]
+    row_stride, column_stride = start.strides[0], start.strides[1]
+    
+    return np.lib.stride_tricks.as_strided(start, 
+                                           shape=(n_rows, n_columns, height, width) + start.shape[2:],
+                                           strides=(row_step*row_stride, column_step*column_stride, 
+                                                    row_stride, column_stride) + start.strides[2:],
+                                           writeable=False)
+
+
+# (ENTRY) function to extract boundaries from a raster image - it reuses the functions defined above
+# current_threshold: a threshold, or a list of thresholds (sweep) - with a list, the filters and markers of every patch are 
+# computed once for all thresholds, and one raster is saved per threshold (see threshold_path)
+# workers, pool: workers of the labelling, started once for the whole extraction (see create_executor, the default runs 
+# all patches serially); chunk_size: see label_patches
+# streaming: read the raster window by window with gdal and write a tiled geotiff (see stream_boundaries)
+# n_passes: number of staggered patch grids, whose boundaries are added (see grid_offsets)
+# preprocess, block_size and halo: filter every patch ('patch') or the whole raster once ('raster'), see boundaries_in_memory
+# marker_method, marker_param: markers of the watershed ('peaks', 'hmaxima' or 'edt_threshold', see generate_markers)
+# cache_dir, cache_size: folder and maximum size in bytes of the on-disk cache of patch masks (None = no cache)
+# backend: 'classical' (find_boundaries) or 'onnx', a segmentation model run on the cpu, e.g. the unet or segformer model 
+# exported to onnx; model_path: the onnx file, batch_size: number of patches per inference (see infer_patches)
+# the onnx backend uses the same patch grids, dilation and merge, but no threshold sweep, raster preprocessing or cache
+# output: 'image' (cv2.imwrite, georeferenced by a tfw if tfw is True) or 'geotiff', a tiled and compressed geotiff with the 
+# georeference of the input raster (the streaming mode always writes one); compression: 'DEFLATE', 'LZW' or None; 
+# overviews: decimation factors of the overviews of the geotiff (e.g. [2, 4, 8], None = no overviews)
+# seam_width: None (n_passes shifted patch grids), or width in pixels of the strips along the seams of the patch grid that are 
+# labelled instead of the shifted grids to recover the boundaries cut at the seams (e.g. a quarter of the patch size); 
+# n_passes is then ignored, see seam_windows
+def extract_boundaries(input_raster, boundaries, patch_shape, current_threshold, rgba, tfw, plot, 
+                       workers=1, pool='process', chunk_size=8, streaming=False, n_passes=2, 
+                       preprocess='patch', block_size=1024, halo=64, marker_method='peaks', marker_param=None, 
+                       cache_dir=None, cache_size=2**30, backend='classical', model_path=None, batch_size=16, 
+                       output='image', compression='DEFLATE', overviews=None, seam_width=None): 
+    
+    print("The input raster is ...", input_raster)
+    offsets = grid_offsets(patch_shape[0], n_passes)
+    
+    if (seam_width is not None): 
+        if (streaming): 
+            raise ValueError("The streaming mode uses shifted patch grids, not seam strips (seam_width=None)")
+        if (not 0 < seam_width <= patch_shape[0]): 
+            raise ValueError(f"The seam width should be between 1 and the patch size ({patch_shape[0]} pixels)")
+        offsets = [0] # the patch grid, the seam strips replace the shifted grids
+    
+    if isinstance(current_threshold, (list, tuple)): 
+        thresholds = list(current_threshold)
+        all_boundaries = [threshold_path(boundaries, thres) for thres in thresholds]
+        print("Thresholds of the sweep: ", thresholds)
+    else: 
+        thresholds = [current_threshold]
+        all_boundaries = [boundaries]
+    
+    if (backend == 'onnx'): 
+        if (len(thresholds) > 1 or preprocess != 'patch' or cache_dir is not None): 
+            raise ValueError("The onnx backend does not use thresholds, raster preprocessing or the patch cache")
+        model = load_model(model_path)
+    elif (backend == 'classical'): 
+        model = None
+    else: 
+        raise ValueError(f"Unknown backend: {backend} (expected 'classical' or 'onnx')")
+    
+    if (output not in ('image', 'geotiff')): 
+        raise ValueError(f"Unknown output: {output} (expected 'image' or 'geotiff')")
+    if (compression not in ('DEFLATE', 'LZW', None)): 
+        raise ValueError(f"Unknown compression: {compression} (expected 'DEFLATE', 'LZW' or None)")
+    geotiff = streaming or output == 'geotiff'
+    if (geotiff and not file_is_of_format("tif", boundaries)):
+        print("WARNING: the boundaries are written as a geotiff - they should have a tif extension")
+    
+    if (streaming and preprocess != 'patch'): 
+        raise ValueError("The streaming mode filters every patch on its own (preprocess='patch')")
+    
+    # one set of workers for all patch grids and strips (the plots and the onnx backend run in the main process)
+    with create_executor(1 if (plot or model is not None) else workers, pool) as executor: 
+        if (streaming): 
+            print("Extracting the boundaries from the input raster (streaming)...")
+            stream_boundaries(input_raster, all_boundaries, patch_shape, thresholds, offsets, executor, chunk_size, 
+                              marker_method, marker_param, cache_dir, model, batch_size, compression, overviews)
+        else: 
+            all_added = boundaries_in_memory(input_raster, patch_shape, thresholds, rgba, plot, offsets, executor, chunk_size, 
+                                             preprocess, block_size, halo, marker_method, marker_param, cache_dir, model, 
+                                             batch_size, seam_width)
+    
+    if (streaming): 
+        print("Boundaries saved at ...", all_boundaries)
+    else: 
+        #save the reconstructed images
+        for added, threshold_boundaries in zip(all_added, all_boundaries): 
+            print("Saving the boundaries at ...", threshold_boundaries)
+            if (geotiff): 
+                save_geotiff(threshold_boundaries, added, input_raster, compression, overviews)
+            else: 
+                cv2.imwrite(threshold_boundaries, added)
     
+    if (cache_dir is not None): 
+        prune_cache(cache_dir, cache_size)
     
-    if (tfw):
+    if (tfw and geotiff): 
+        print("The georeference is part of the geotiff - no tfw file is generated")
+    elif (tfw):
         # Read pixel to utm coordinate transformation parameters
         info = gdal.Info(input_raster, format='json')
         
@@ -272,10 +1090,11 @@ def extract_boundaries(input_raster, boundaries, patch_shape, current_threshold,
             print("WARNING: input raster is not a tif file - no meaningful tfw file can be generated")
         
         # generate a tfw file for the boundaries
-        generate_tfw(boundaries, info)
+        for threshold_boundaries in all_boundaries: 
+            generate_tfw(threshold_boundaries, info)
     
 # end time
 end = time.time()
 
 # total time taken
-print(f"Runtime of the program: {end - start} seconds")
+print(f"Runtime of the program: {end - start} seconds")
\ No newline at end of file
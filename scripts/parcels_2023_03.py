@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+"""
+Parcels from the skeleton of the extracted boundaries, shared by both vectorizers (vectorizer_grass_2023_02 and 
+vectorizer_grass_2023_02_2douglas, which only differ in the thresholds of their postprocessing): skeleton, contours and 
+labelled components of the skeleton, georeferencing, area filters, generalization in memory, incremental re-vectorization 
+and writers of the vector outputs.
+
+Note: the entry function, if any, is specified last. The keyword (ENTRY) is mentioned in the comments
+describing that function. The entry function is the one that is called first among all functions.
+All other functions are listed in the alphabetical order
+"""
+
+
+import cv2 # read image, create contours
+import json
+import numpy as np # mathematical functions on multi-dimensional arrays and matrices
+import os
+import shapely # vectorized geometry constructors (shapely 2)
+
+from osgeo import gdal
+from osgeo import ogr # write binary vector formats
+from osgeo import osr
+from pyproj import Geod
+from shapely.geometry import Polygon # create a polygon
+
+from reprojection_2023_03 import transform_geometries # coordinate conversion
+
+
+# relative margin around the area threshold: the geodesic area of a polygon is computed exactly only if its area
+# estimated from the pixels is within this margin of the threshold, the others are kept or dropped on the estimate
+AREA_MARGIN = 0.05
+
+# vector formats of the outputs (ogr driver names) and their file extensions; FlatGeobuf and GPKG have a spatial index
+VECTOR_EXTENSIONS = {'GeoJSON': '.geojson', 'FlatGeobuf': '.fgb', 'GPKG': '.gpkg'}
+# features serialized at once by the streaming geojson writer
+GEOJSON_CHUNK = 1000
+
+# simplification of the contours in pixel space (see contours_from_mask): the one-pixel steps of the staircases are within
+# one pixel of the line through their ends, and the contours are simplified by a share of the first douglas threshold 
+# of the postprocessing beyond that, so that the generalization of the postprocessing still decides the final shape
+STAIRCASE_PIXELS = 1.0
+PRESIMPLIFY_SHARE = 0.5
+
+# thinning of Zhang and Suen as in skimage.morphology.skeletonize (see skeletonize_mask): removability of a pixel from the
+# code of its 8 neighbours (1 upper-left, 2 up, 4 upper-right, 8 right, 16 lower-right, 32 down, 64 lower-left, 128 left), 
+# 1 = removed in the first sub-iteration, 2 = in the second one, 3 = in both
+THINNING_TABLE = np.array([0, 0, 0, 1, 0, 0, 1, 3, 0, 0, 3, 1, 1, 0, 1, 3, 0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 2, 0,
+                           3, 0, 3, 3, 0, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                           2, 0, 0, 0, 3, 0, 2, 2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                           0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, 2, 0, 0, 0,
+                           3, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0, 0, 3, 0, 2, 0, 0, 0, 3, 1, 0, 0, 1, 3, 0, 0, 0, 0,
+                           0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 3, 1, 0, 0, 0, 0, 0, 0,
+                           0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 3, 1, 3,
+                           0, 0, 1, 3, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                           2, 3, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 3, 3, 0, 1, 0, 0, 0, 0, 2, 2, 0, 0,
+                           2, 0, 0, 0], dtype=np.uint8)
+
+
+# outlines of components of a label image (see label_parcels), each one through the outer pixels of its component
+# stats: those of cv2.connectedComponentsWithStats; returns the labels whose outline has at least 3 points and the outlines
+def component_outlines (label_image, stats, labels): 
+    left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    right, bottom = left + stats[:, cv2.CC_STAT_WIDTH], top + stats[:, cv2.CC_STAT_HEIGHT]
+    
+    outline_labels, outlines = [], []
+    for label in labels: 
+        crop = (label_image[top[label]:bottom[label], left[label]:right[label]] == label).view(np.uint8)
+        outline = max(cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0], key=len)
+        if (len(outline) >= 3): 
+            outline_labels.append(label)
+            outlines.append(np.squeeze(outline, axis=1) + (left[label], top[label]))
+    
+    return np.array(outline_labels, dtype=np.int32), outlines
+
+# georeference contours (pixel coordinates) and build their polygons, converted to wgs84, all at once
+# returns the polygons and their areas in m^2 estimated from the pixels (pixel_area: see geodesic_pixel_area)
+def contour_polygons (contours, gt, source_epsg, pixel_area): 
+    print("Georefencing the polygons...")
+    
+    skel_polygons = []
+    estimated_areas = []
+    if (len(contours) > 0): 
+        # all contours in one array of points, ring_ids says to which contour each point belongs
+        points = np.concatenate(contours)
+        ring_ids = np.repeat(np.arange(len(contours)), [len(cnt) for cnt in contours])
+        
+        # 1 - transform coordinates of all contours into georeferenced (projected coordinates) at once
+        # 2- build all polygons from the projected coordinates at once (shapely 2 vectorized constructors)
+        # 3- transform the projected coordinates of all polygons into geographic coordinates at once
+        rings_utm = shapely.linearrings(georeference(points, gt), indices=ring_ids)
+        polys_utm = shapely.polygons(rings_utm)
+        # https://shapely.readthedocs.io/en/stable/manual.html#constructive-methods
+        polys_buffer = shapely.buffer(polys_utm, 0, join_style='mitre')
+        skel_polygons = list(towgs84(polys_buffer, source_epsg))
+        # area in pixels (the georeferencing scales the areas by the determinant of the geotransform) times pixel_area
+        estimated_areas = shapely.area(polys_buffer)/abs(gt[1]*gt[5] - gt[2]*gt[4])*pixel_area
+    
+    return skel_polygons, estimated_areas
+
+# generate contours from masks
+# tolerance: distance in pixels within which the contours are simplified (approxPolyDP), 0 = not simplified. The parcels
+# on both sides of a boundary trace the same pixels of the skeleton, so a pixel kept by any contour is kept by all contours
+# through it, and the shared boundaries stay the same
+def contours_from_mask (image, tolerance=0):     
+    # we are interested in the contours of the inner polygons only. RETR_CCOMP organizes the contours in two levels: 
+    # the outer contours of the connected components, and the inner contours (holes) of each component, whose parent 
+    # (4th value of their row in the hierarchy) is the outer contour - so a single call is enough to keep the inner ones
+    # the outer contour of a component inside a parcel (a stroke, or a closed loop drawn inside it) is not kept either: 
+    # the parcel of a closed loop is its hole, that is already kept
+    # RETR_CCOMP, see doc at https://docs.opencv.org/4.x/d9/d8b/tutorial_py_contours_hierarchy.html
+    # https://docs.opencv.org/2.4/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html?highlight=findcontours#findcontours
+    
+    inner_polygons = []
+
+    # generate inner+outer contours
+    contours_ei, hierarchy_ei = cv2.findContours(image, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy_ei is None: # no contour at all
+        return inner_polygons
+
+    # go through all inner+outer contours
+    kept_pixels = []
+    for item, (next_contour, previous_contour, first_child, parent) in zip(contours_ei, hierarchy_ei[0]):
+        if (parent != -1 and tolerance > 0): 
+            # the staircases of the skeleton are removed before the contours are georeferenced
+            kept_pixels.append(cv2.approxPolyDP(item, tolerance, True).reshape(-1, 2))
+        item = np.squeeze(item) # removing redundant dimensions
+        
+        # keep only those that are relevant (i.e. inner contours with at least 3 points)
+        if (parent != -1 and len(item) >= 3): 
+            inner_polygons.append(item)
+    
+    if tolerance > 0 and len(inner_polygons) > 0: 
+        width = image.shape[1]
+        kept_pixels = np.concatenate(kept_pixels)
+        kept_pixels = np.unique(kept_pixels[:, 1].astype(np.int64)*width + kept_pixels[:, 0])
+        sizes = np.array([len(item) for item in inner_polygons])
+        points = np.concatenate(inner_polygons)
+        kept = np.isin(points[:, 1].astype(np.int64)*width + points[:, 0], kept_pixels)
+        # number of kept points of each contour, all contours are split at once
+        kept_sizes = np.add.reduceat(kept.astype(np.int64), np.cumsum(sizes) - sizes)
+        inner_polygons = [item for item in np.split(points[kept], np.cumsum(kept_sizes)[:-1]) if len(item) >= 3]
+        print(f"Vertices of the inner contours: {len(points)} before, {sum(len(item) for item in inner_polygons)} after "
+              f"the simplification within {tolerance:.2f} pixels")
+                
+    return inner_polygons
+
+# keep only polygons that have an area greater than a threshold (see geodesic_area_mask)
+def filter_by_geodesic_area (threshold, polygons, estimated_areas=None):
+    
+    keep = geodesic_area_mask(threshold, polygons, estimated_areas)
+    filtered_polygons = [poly for poly, kept in zip(polygons, keep) if kept]
+    
+    return filtered_polygons
+
+# drop the contours whose polygon is clearly smaller than the threshold (m^2), before they are georeferenced
+# the polygon of a contour (even once repaired by buffer(0)) lies within the convex hull of the contour, so the area
+# of the hull in pixels times pixel_area (see geodesic_pixel_area) is an upper bound of the area of the polygon
+def filter_by_pixel_area (threshold, contours, pixel_area): 
+    return [cnt for cnt in contours 
+            if cv2.contourArea(cv2.convexHull(cnt))*pixel_area >= threshold*(1 - AREA_MARGIN)]
+
+# generalize the boundaries of parcels (wgs84 polygons, longitude first) with douglas-peucker at threshold (degrees),
+# as v.generalize does on the topology built by v.in_ogr: the boundaries are split into arcs between the nodes where
+# parcels meet, each arc is simplified once with its end nodes kept, so that neighbouring parcels keep the same edge,
+# and the areas are rebuilt from the simplified arcs. Each area takes the id of the parcel that covers at least half of
+# it, of the smallest one if several do: a parcel drawn inside another one is also covered by the outer parcel (see
+# parcel_exteriors), so that the area of the inner parcel keeps its id. Areas mostly outside of the parcels (gaps between
+# them) are dropped
+# returns the areas and their parcel ids, ordered by parcel id
+def generalize_parcels (parcels, parcel_ids, threshold): 
+    if len(parcels) == 0: 
+        return np.array([], dtype=object), np.array([], dtype=int)
+    parcels = np.asarray(parcels, dtype=object)
+    
+    # unary_union nodes the boundaries where they meet, line_merge joins the segments between two nodes into one arc
+    arcs = shapely.get_parts(shapely.line_merge(shapely.unary_union(shapely.boundary(parcels))))
+    arcs = shapely.simplify(arcs, threshold, preserve_topology=False)
+    # the simplified arcs may cross each other, so they are noded again before the areas are rebuilt
+    areas = shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.unary_union(arcs))))
+    
+    # smallest parcel covering at least half of each area
+    area_index, parcel_index = shapely.STRtree(parcels).query(areas, predicate='intersects')
+    overlap = shapely.area(shapely.intersection(areas[area_index], parcels[parcel_index]))
+    covering = overlap >= 0.5*shapely.area(areas[area_index])
+    area_index, parcel_index = area_index[covering], parcel_index[covering]
+    order = np.lexsort((shapely.area(parcels)[parcel_index], area_index))
+    area_index, parcel_index = area_index[order], parcel_index[order]
+    first = np.unique(area_index, return_index=True)[1]
+    areas, ids = areas[area_index[first]], np.asarray(parcel_ids)[parcel_index[first]]
+    
+    order = np.argsort(ids, kind='stable')
+    return areas[order], ids[order]
+
+# whether each polygon has an area greater than a threshold
+# estimated_areas (optional): area of each polygon in m^2 estimated from its pixels, the geodesic area is then computed
+# only for the polygons whose estimate is within AREA_MARGIN of the threshold
+def geodesic_area_mask (threshold, polygons, estimated_areas=None):
+    
+    # use the WGS84 ellipsoid to calculate the geodesic area
+    geod = Geod(ellps="WGS84")
+
+    if estimated_areas is None:
+        return np.array([abs(geod.geometry_area_perimeter(poly)[0]) >= threshold for poly in polygons], dtype=bool)
+
+    estimated_areas = np.asarray(estimated_areas)
+    near = (estimated_areas >= threshold*(1 - AREA_MARGIN)) & (estimated_areas < threshold*(1 + AREA_MARGIN))
+    print(f"Geodesic area computed for {np.count_nonzero(near)} of {len(polygons)} polygons (near the threshold)")
+    
+    return np.array([(abs(geod.geometry_area_perimeter(poly)[0]) if exact else area) >= threshold
+                     for poly, area, exact in zip(polygons, estimated_areas, near)], dtype=bool)
+
+# geodesic area in m^2 of a pixel at the centre of the image (width x height pixels), as filter_by_geodesic_area
+# measures it: a square of 100 x 100 pixels is georeferenced and converted to wgs84 as the polygons are.
+# The area of a pixel varies little over a sketch map (well within AREA_MARGIN)
+def geodesic_pixel_area (gt, source_epsg, width, height): 
+    side = 100
+    x, y = width//2, height//2
+    square = np.array([[x, y], [x + side, y], [x + side, y + side], [x, y + side]])
+    polygon = towgs84(Polygon(georeference(square, gt)), source_epsg)
+    return abs(Geod(ellps="WGS84").geometry_area_perimeter(polygon)[0])/side**2
+
+# georeference pixel coordinates, formula from https://gdal.org/tutorials/geotransforms_tut.html
+# points: array of pixel coordinates (column, row), e.g. the points of all contours at once
+def georeference (points, gt): 
+    x_geo = gt[0] + points[:, 0] * gt[1] + points[:, 1] * gt[2]
+    y_geo = gt[3] + points[:, 0] * gt[4] + points[:, 1] * gt[5]
+    return np.column_stack((x_geo, y_geo))
+
+# parcels as the connected components of the pixels between the boundaries (4-connected pixels outside of the skeleton),
+# labelled in one pass with their statistics: the components that touch the border of the image (the background
+# around the sketch) and those whose pixel count times pixel_area is clearly below threshold (m^2) are dropped before
+# any geometry is built; the outline of each parcel runs through its outer pixels
+# returns the label image (int32, 0 = skeleton), the labels of the parcels and their outlines (pixel coordinates)
+def label_parcels (skeleton, threshold, pixel_area): 
+    height, width = skeleton.shape
+    n_labels, label_image, stats, centroids = cv2.connectedComponentsWithStats((skeleton == 0).view(np.uint8), 
+                                                                                connectivity=4, ltype=cv2.CV_32S)
+    left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    right, bottom = left + stats[:, cv2.CC_STAT_WIDTH], top + stats[:, cv2.CC_STAT_HEIGHT]
+    
+    background = (left == 0) | (top == 0) | (right == width) | (bottom == height)
+    keep = ~background & (stats[:, cv2.CC_STAT_AREA]*pixel_area >= threshold*(1 - AREA_MARGIN))
+    keep[0] = False # the skeleton
+    print(f"Components between the boundaries: {n_labels - 1}, dropped from their statistics: {n_labels - 1 - np.count_nonzero(keep)}")
+    
+    labels, outlines = component_outlines(label_image, stats, np.flatnonzero(keep))
+    
+    return label_image, labels, outlines
+
+# check if the file provided as input is of a given format
+def of_format(data_format, source_file): 
+    
+    file_format = source_file.rsplit(".", 1)[1]
+    
+    if (file_format == data_format): 
+        return True
+    else:
+        return False
+
+# path of the postprocessed output of a raw polygons geojson file, in the given vector format
+def output_path (raw_path, vector_format): 
+    return raw_path[:-12]+VECTOR_EXTENSIONS[vector_format]
+
+# fixing the holes - Keeping the exterior ring only from every polygon
+# returns the parcels and the index of the polygon of each parcel in polygons
+def parcel_exteriors (polygons): 
+    #some polygons are multipolygons, so two options are needed
+    parcels=[]
+    origins=[] # index of the polygon of each parcel in polygons
+    for index, poly in enumerate(polygons):
+        if poly.geom_type == 'MultiPolygon':
+            try:
+                Polygons = list(poly)# do multipolygon things.
+                for multiparts in Polygons:
+                    new_polygon = Polygon(multiparts.exterior.coords, holes=None)
+                    parcels.append(new_polygon)
+                    origins.append(index)
+            except:
+                print("a multipolygon is skipped, resolve this after testing")
+            #Polygons = list(poly['geom'].iloc[0].geoms)# do multipolygon things.
+        elif poly.geom_type == 'Polygon':
+            new_polygon = Polygon(poly.exterior.coords, holes=None)
+            parcels.append(new_polygon)
+            origins.append(index)
+        else:
+            print("Error: not a polygon")
+    
+    return parcels, origins
+
+def parcel_ID(parcel): 
+
+    return parcel['properties']['parcelID']   
+
+# permute coordinate of polygons (if needed): polygon or array of polygons, all coordinates are permuted at once
+def permute_coordinates (x):
+    return shapely.transform(x, lambda coordinates: coordinates[:, ::-1])
+
+# size in degrees (wgs84) of a pixel at the centre of the image (width x height pixels): mean length of a row and
+# of a column of 100 pixels, georeferenced and converted to wgs84 as the polygons are
+def pixel_degrees (gt, source_epsg, width, height): 
+    side = 100
+    x, y = width//2, height//2
+    lines = shapely.linestrings([georeference(np.array([[x, y], [x + side, y]]), gt), 
+                                 georeference(np.array([[x, y], [x, y + side]]), gt)])
+    return float(np.mean(shapely.length(towgs84(lines, source_epsg))))/side
+
+# path of the postprocessed polygons of generate_polygons for its geojson_path (e.g. 'parcels.json' -> 'parcels.geojson')
+def polygons_path (geojson_path, vector_format='GeoJSON'): 
+    return output_path(raw_geojson_path(geojson_path), vector_format)
+
+# path of the raw polygons geojson of generate_polygons for its geojson_path (a .json path, e.g. 'parcels.json')
+def raw_geojson_path (geojson_path): 
+    return geojson_path[:-5]+"_raw.geojson"
+
+# drop the areas (wgs84 polygons, longitude first) smaller than threshold (m^2), as v.clean tool=rmarea does for areas
+# without neighbours - areas with neighbours are dropped too instead of being merged into them
+def remove_small_areas (areas, parcel_ids, threshold): 
+    geod = Geod(ellps="WGS84")
+    keep = np.array([abs(geod.geometry_area_perimeter(area)[0]) >= threshold for area in areas], dtype=bool)
+    return areas[keep], parcel_ids[keep]
+
+# re-vectorize the boundaries (mask) only around their changes since the previous run (previous_mask, same size), whose
+# parcels (wgs84 polygons, longitude first) and properties come from polygonizer='labels' and whose label image is saved
+# at labels_path (updated in place). The skeletons of both masks are computed in full, since a change of the boundaries
+# can move the skeleton far away from it (see skeletonize_mask). The zone is the box around the changes of the boundaries
+# and of their skeleton: the previous parcels that reach it are replaced by the components of the new skeleton that reach
+# it. The window where the new skeleton is labelled grows until it holds all of them, the components that reach the border
+# of the image being the background. Each new parcel takes the parcelID (and properties) of the replaced parcel it covers
+# most, if that one is not taken yet, the others get new parcelIDs; the other parcels are kept as they are
+# returns the parcels and their properties, ordered by parcelID
+def revectorize_changes (mask, previous_mask, parcels, properties, labels_path, gt, source_epsg, threshold, pixel_area, 
+                         tile_size): 
+    height, width = mask.shape
+    if not np.any(mask != previous_mask): 
+        print("No change in the boundaries, the parcels are kept as they are")
+        return parcels, properties
+    
+    full_skeleton = skeletonize_mask(mask, tile_size)
+    rows, cols = np.nonzero((mask != previous_mask) | (full_skeleton != skeletonize_mask(previous_mask, tile_size)))
+    # zone where the skeleton or the boundaries changed, one pixel wider for the parcels next to it
+    zone = (max(rows.min() - 1, 0), min(rows.max() + 2, height), max(cols.min() - 1, 0), min(cols.max() + 2, width))
+    top, bottom, left, right = zone
+    
+    # paper around the sketch: the pixels off the boundaries (before and after the changes, so off both skeletons) that
+    # are connected to the border of the image, the components that reach them are the background
+    n_paper, paper = cv2.connectedComponents(((mask == 0) & (previous_mask == 0)).view(np.uint8), connectivity=4, 
+                                             ltype=cv2.CV_32S)
+    paper_labels = np.setdiff1d(np.concatenate((paper[0], paper[-1], paper[:, 0], paper[:, -1])), 0)
+    
+    dataset = gdal.Open(labels_path, gdal.GA_Update)
+    band = dataset.GetRasterBand(1)
+    while True: 
+        previous_labels = band.ReadAsArray(left, top, right - left, bottom - top)
+        skeleton = full_skeleton[top:bottom, left:right]
+        n_labels, label_image, stats, centroids = cv2.connectedComponentsWithStats((skeleton == 0).view(np.uint8), 
+                                                                                    connectivity=4, ltype=cv2.CV_32S)
+        
+        # previous parcels and new components that reach the zone
+        in_zone = (slice(zone[0] - top, zone[1] - top), slice(zone[2] - left, zone[3] - left))
+        replaced = np.setdiff1d(previous_labels[in_zone], 0)
+        reached = np.zeros(n_labels, dtype=bool)
+        reached[label_image[in_zone]] = True
+        reached[0] = False # the skeleton
+        
+        # sides of the window (top, bottom, left, right) reached by each component, the background reaches the border
+        # of the image or the paper around the sketch
+        c_left, c_top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+        c_right, c_bottom = c_left + stats[:, cv2.CC_STAT_WIDTH], c_top + stats[:, cv2.CC_STAT_HEIGHT]
+        on_side = [c_top == 0, c_bottom == bottom - top, c_left == 0, c_right == right - left]
+        background = np.any([reaches & at_border for reaches, at_border in 
+                             zip(on_side, [top == 0, bottom == height, left == 0, right == width])], axis=0)
+        background[label_image[np.isin(paper[top:bottom, left:right], paper_labels)]] = True
+        sides = [previous_labels[0], previous_labels[-1], previous_labels[:, 0], previous_labels[:, -1]]
+        grow = [np.any(reached & reaches & ~background) or np.any(np.isin(side, replaced)) 
+                for reaches, side in zip(on_side, sides)]
+        if not any(grow): 
+            break
+        
+        # some of them go on outside of the window: it doubles in size beyond the sides they reach
+        grow_y, grow_x = bottom - top, right - left
+        top, bottom = max(top - grow[0]*grow_y, 0), min(bottom + grow[1]*grow_y, height)
+        left, right = max(left - grow[2]*grow_x, 0), min(right + grow[3]*grow_x, width)
+    
+    print(f"Re-vectorizing {bottom - top} x {right - left} pixels around the changes "
+          f"({100*(bottom - top)*(right - left)/(height*width):.1f} % of the sheet)...")
+    keep = reached & ~background & (stats[:, cv2.CC_STAT_AREA]*pixel_area >= threshold*(1 - AREA_MARGIN))
+    outline_labels, outlines = component_outlines(label_image, stats, np.flatnonzero(keep))
+    polygons, estimated_areas = contour_polygons([outline + (left, top) for outline in outlines], gt, source_epsg, pixel_area)
+    kept = geodesic_area_mask(threshold, polygons, estimated_areas)
+    new_parcels, origins = parcel_exteriors([poly for poly, k in zip(polygons, kept) if k])
+    new_labels = outline_labels[kept][origins]
+    
+    # replaced parcel covering most of each new component (pixels of both), each one taken once
+    both = np.isin(previous_labels, replaced) & np.isin(label_image, new_labels)
+    pairs, overlap = np.unique(previous_labels[both].astype(np.int64)*n_labels + label_image[both], return_counts=True)
+    inherited = {} # replaced label of each new component
+    for pair in pairs[np.argsort(-overlap, kind='stable')]: 
+        previous_label, label = divmod(int(pair), n_labels)
+        if label not in inherited and previous_label not in inherited.values(): 
+            inherited[label] = previous_label
+    
+    replaced_properties = {} # properties of the first parcel of each replaced label
+    kept_parcels, kept_properties = [], []
+    for parcel, parcel_properties in zip(parcels, properties): 
+        if parcel_properties['labelID'] in replaced: 
+            replaced_properties.setdefault(parcel_properties['labelID'], parcel_properties)
+        else: 
+            kept_parcels.append(parcel)
+            kept_properties.append(parcel_properties)
+    
+    next_id = max([parcel_properties['parcelID'] for parcel_properties in properties], default=0) + 1
+    next_label = max([parcel_properties['labelID'] for parcel_properties in properties], default=0) + 1
+    label_values = {} # label of each new component in the label image
+    for parcel, label in zip(permute_coordinates(np.asarray(new_parcels, dtype=object)), new_labels): 
+        label = int(label)
+        if label not in label_values and label in inherited: 
+            parcel_properties = dict(replaced_properties[inherited[label]])
+        else: 
+            parcel_properties = {"parcelID": next_id, "parcelType": "n/a"}
+            next_id += 1
+        parcel_properties['labelID'] = label_values.setdefault(label, next_label + len(label_values))
+        kept_parcels.append(parcel)
+        kept_properties.append(parcel_properties)
+    print(f"Parcels replaced: {len(replaced)}, new parcels: {len(new_parcels)} ({len(inherited)} with the parcelID of a replaced one)")
+    
+    # the replaced parcels lie within the window, so only the window of the label image changes
+    lookup = np.zeros(n_labels, dtype=np.int32)
+    lookup[list(label_values)] = list(label_values.values())
+    previous_labels[np.isin(previous_labels, replaced)] = 0
+    new_values = lookup[label_image]
+    previous_labels = np.where(new_values > 0, new_values, previous_labels)
+    band.WriteArray(previous_labels, left, top)
+    dataset.FlushCache()
+    dataset = None
+    
+    order = np.argsort([parcel_properties['parcelID'] for parcel_properties in kept_properties], kind='stable')
+    return np.asarray(kept_parcels, dtype=object)[order], [kept_properties[k] for k in order]
+
+# save the labels of a label image (int32) as a georeferenced geotiff (tiled, compressed), the pixels of the other
+# labels are set to 0 (no parcel) in place
+def save_labels (labels_path, label_image, labels, gt, projection): 
+    lookup = np.zeros(int(label_image.max()) + 1, dtype=np.int32)
+    lookup[labels] = labels
+    np.take(lookup, label_image, out=label_image)
+    
+    dataset = gdal.GetDriverByName('GTiff').Create(labels_path, label_image.shape[1], label_image.shape[0], 1, gdal.GDT_Int32, 
+                                                   options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform(gt)
+    dataset.SetProjection(projection)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(label_image)
+    dataset.FlushCache()
+    dataset = None
+
+# skeleton of a mask (uint8 or bool, non-zero = boundary) as uint8 (0 or 255), the same as skimage.morphology.skeletonize
+# without its float and bool copies of the mask. Tiles cannot be thinned apart: the removal of a pixel can decide the one
+# of its neighbours at the next sub-iteration, and such chains run along thin diagonal lines far beyond the thickness of
+# the boundaries. The whole mask is thinned in place instead, but each sub-iteration only looks at the pixels that may be
+# removed: the border of the boundaries at first (found on strips of tile_size rows), then the pixels left removable
+# and the neighbours of the removed ones. Their neighbourhoods are read before any removal, tile_size x tile_size pixels
+# at once, so that the result is that of the parallel thinning of skimage
+def skeletonize_mask (mask, tile_size): 
+    height, width = mask.shape
+    skeleton = np.zeros((height + 2, width + 2), dtype=np.uint8) # one pixel of background around the mask
+    pixels = skeleton.ravel()
+    row = width + 2
+    offsets = np.array([-row - 1, -row, -row + 1, 1, row + 1, row, row - 1, -1]) # in the order of THINNING_TABLE
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    
+    candidates = []
+    for top in range(0, height, tile_size): 
+        bottom = min(top + tile_size, height)
+        skeleton[top + 1:bottom + 1, 1:-1] = mask[top:bottom] != 0
+    for top in range(0, height, tile_size): 
+        strip = skeleton[top:min(top + tile_size, height) + 2]
+        candidates.append(np.flatnonzero(strip[1:-1] > cv2.erode(strip, kernel)[1:-1]) + (top + 1)*row)
+    candidates = np.concatenate(candidates)
+    
+    # sub-iterations until two in a row remove nothing
+    chunk = tile_size*tile_size
+    first_pass, idle = True, 0
+    while idle < 2 and len(candidates) > 0: 
+        kept, removed = [], []
+        for start in range(0, len(candidates), chunk): 
+            pixel = candidates[start:start + chunk]
+            code = np.zeros(len(pixel), dtype=np.uint8)
+            for bit, offset in enumerate(offsets): 
+                code |= pixels[pixel + offset] << bit
+            removability = THINNING_TABLE[code]
+            removable = (removability == 3) | (removability == (1 if first_pass else 2))
+            kept.append(pixel[(removability != 0) & ~removable])
+            removed.append(pixel[removable])
+        removed = np.concatenate(removed)
+        pixels[removed] = 0
+        for start in range(0, len(removed), chunk): 
+            neighbours = (removed[start:start + chunk, None] + offsets).ravel()
+            kept.append(neighbours[pixels[neighbours] != 0])
+        candidates = np.sort(np.concatenate(kept))
+        candidates = candidates[np.diff(candidates, prepend=-1) != 0]
+        idle = 0 if len(removed) > 0 else idle + 1
+        first_pass = not first_pass
+    
+    skeleton = skeleton[1:-1, 1:-1]
+    skeleton *= 255
+    return skeleton
+
+# convert from utm coordinate to wgs84, x is a polygon or an array of polygons (converted in one call)
+# the transformer is built once per source epsg, see reprojection_2023_03
+def towgs84 (x, source_epsg): 
+    return transform_geometries(x, source_epsg, 'EPSG:4326')
+
+# write features (geometries in wgs84, longitude first, and one dictionary of properties per feature) in vector_format:
+# geojson is streamed (see write_geojson), the other formats are written with ogr (see write_ogr)
+def write_features (vector_path, geometries, properties, vector_format): 
+    if vector_format == 'GeoJSON': 
+        write_geojson(vector_path, geometries, properties)
+    else: 
+        write_ogr(vector_path, geometries, properties, vector_format)
+
+# write features as a geojson FeatureCollection, GEOJSON_CHUNK features at a time: the geometries of a chunk are
+# serialized at once by shapely (see to_geojson), the features are written as they are serialized
+def write_geojson (geojson_path, geometries, properties): 
+    with open(geojson_path, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for start in range(0, len(geometries), GEOJSON_CHUNK): 
+            chunk = shapely.to_geojson(np.asarray(geometries[start:start + GEOJSON_CHUNK], dtype=object))
+            f.write(', '.join('{"type": "Feature", "geometry": ' + geometry + ', "properties": ' + json.dumps(feature_properties) + '}' 
+                              for geometry, feature_properties in zip(chunk, properties[start:start + GEOJSON_CHUNK])))
+            if start + GEOJSON_CHUNK < len(geometries): 
+                f.write(', ')
+        f.write(']}')
+
+# write features in a binary vector format with a spatial index (ogr driver vector_format, e.g. FlatGeobuf or GPKG),
+# in one transaction; the fields are those of the first feature (integer or string)
+def write_ogr (vector_path, geometries, properties, vector_format): 
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER) # longitude first
+    
+    driver = ogr.GetDriverByName(vector_format)
+    if os.path.exists(vector_path): 
+        driver.DeleteDataSource(vector_path)
+    dataset = driver.CreateDataSource(vector_path)
+    layer = dataset.CreateLayer('parcels', srs, ogr.wkbUnknown, options=['SPATIAL_INDEX=YES'])
+    for name, value in (properties[0].items() if len(properties) > 0 else []): 
+        layer.CreateField(ogr.FieldDefn(name, ogr.OFTInteger if isinstance(value, (int, np.integer)) else ogr.OFTString))
+    
+    definition = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for wkb, feature_properties in zip(shapely.to_wkb(np.asarray(geometries, dtype=object)), properties): 
+        feature = ogr.Feature(definition)
+        for name, value in feature_properties.items(): 
+            feature.SetField(name, value)
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    dataset = None
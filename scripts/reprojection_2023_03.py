@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Coordinate transformations shared by the vectorizer and the sticker OCR.
+
+Note: the entry function, if any, is specified last. The keyword (ENTRY) is mentioned in the comments
+describing that function. The entry function is the one that is called first among all functions.
+All other functions are listed in the alphabetical order
+
+Building a pyproj transformer is the expensive part of a reprojection, so the transformers are cached by
+(source, target) and whole coordinate arrays are transformed in a single call.
+The axis order is the one of the crs definitions (e.g. latitude first for EPSG:4326), as with Transformer.from_crs.
+"""
+
+
+from functools import lru_cache
+
+import numpy as np # mathematical functions on multi-dimensional arrays and matrices
+import pyproj
+import shapely
+
+
+# transformer from the crs source to the crs target (anything pyproj.CRS accepts, e.g. 'EPSG:32631'), built once
+# per (source, target) and then taken from the cache (least recently used transformers are dropped first)
+@lru_cache(maxsize=16)
+def get_transformer(source, target):
+
+    return pyproj.Transformer.from_crs(pyproj.CRS(source), pyproj.CRS(target))
+
+
+# transform an array of coordinates of shape (points, 2) from the crs source to the crs target in one call
+def transform_coordinates(coordinates, source, target):
+
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    x, y = get_transformer(source, target).transform(coordinates[:, 0], coordinates[:, 1])
+
+    return np.column_stack((x, y))
+
+
+# transform a shapely geometry, or an array of shapely geometries, from the crs source to the crs target:
+# the coordinates of all geometries are transformed in one call
+def transform_geometries(geometries, source, target):
+
+    return shapely.transform(geometries, lambda coordinates: transform_coordinates(coordinates, source, target))
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Planar graph of the skeleton of the parcel boundaries: the parcels are the faces of the graph, so that the boundary
+shared by two parcels is a single edge (traced, georeferenced and simplified once, stored once in topojson).
+
+Note: the entry function, if any, is specified last. The keyword (ENTRY) is mentioned in the comments
+describing that function. The entry function is the one that is called first among all functions.
+All other functions are listed in the alphabetical order
+
+Steps
+-----
+link the 8-connected pixels of the skeleton (a diagonal link only where no pixel already joins both ends)
+split the links into edges: chains of pixels with two links between nodes (pixels with any other number of links)
+build the faces of the graph from the edges (the edges that bound no face, e.g. stray strokes, are left out)
+find the edges of each face, hence the neighbours of each parcel and the arcs of the topojson
+-----
+"""
+
+
+import json
+
+import numpy as np # mathematical functions on multi-dimensional arrays and matrices
+import shapely
+
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+# neighbours of each face: the faces that share an edge with it (indices, in increasing order)
+def face_adjacency(edges, faces):
+
+    face_index, edge_index = face_edges(edges, faces)
+
+    # edges of two faces, i.e. pairs of consecutive rows with the same edge
+    shared = np.flatnonzero(edge_index[1:] == edge_index[:-1])
+    neighbours = [set() for _ in range(len(faces))]
+    for a, b in zip(face_index[shared], face_index[shared + 1]):
+        neighbours[a].add(int(b))
+        neighbours[b].add(int(a))
+
+    return [sorted(n) for n in neighbours]
+
+
+# edges of each face (the edges that lie on its boundary): (face index, edge index) pairs, sorted by edge
+# the faces should be built from the edges (see graph_faces), so that their boundaries have the same coordinates
+def face_edges(edges, faces):
+
+    if len(edges) == 0 or len(faces) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    face_index, edge_index = shapely.STRtree(edges).query(shapely.boundary(faces), predicate='covers')
+    order = np.lexsort((face_index, edge_index))
+
+    return face_index[order], edge_index[order]
+
+
+# faces of the planar graph given by its edges (linestrings that only meet at their end points), as polygons
+def graph_faces(edges):
+
+    if len(edges) == 0:
+        return np.array([], dtype=object)
+
+    return shapely.get_parts(shapely.polygonize(edges))
+
+
+# index of each linear index q in the sorted linear indices of the skeleton pixels, -1 if q is not a skeleton pixel
+def pixel_index(pixels, q):
+
+    k = np.minimum(np.searchsorted(pixels, q), len(pixels) - 1)
+
+    return np.where(pixels[k] == q, k, -1)
+
+
+# links between the 8-connected pixels of a skeleton (non-zero pixels): pairs of indices into pixels, the linear indices
+# of the skeleton pixels. A diagonal link is only made where neither pixel that joins both ends is part of the skeleton,
+# so that the corners of the staircases do not become small triangles of the graph
+def pixel_links(pixels, width):
+
+    col = pixels % width
+    has_right, has_left = col < width - 1, col > 0
+    right = np.where(has_right, pixel_index(pixels, pixels + 1), -1)
+    left = np.where(has_left, pixel_index(pixels, pixels - 1), -1)
+    down = pixel_index(pixels, pixels + width)
+    down_right = np.where(has_right & (right < 0) & (down < 0), pixel_index(pixels, pixels + width + 1), -1)
+    down_left = np.where(has_left & (left < 0) & (down < 0), pixel_index(pixels, pixels + width - 1), -1)
+
+    index = np.arange(len(pixels))
+    links = [np.column_stack((index[other >= 0], other[other >= 0])) for other in [right, down, down_right, down_left]]
+
+    return np.concatenate(links)
+
+
+# arcs of a ring (closed coordinates) made of edges: lookup maps the first two points of an edge, in both directions,
+# to the edge and whether it is traversed backwards; n_points: number of points of each edge
+# returns the edges of the ring in order, ~edge for the edges traversed backwards (as in topojson)
+def ring_arcs(ring, lookup, n_points):
+
+    n = len(ring) - 1
+    keys = [(tuple(ring[k]), tuple(ring[k + 1])) for k in range(n)]
+
+    # the ring may start within an edge (e.g. a face bounded by a single closed edge)
+    start = next((k for k in range(n) if keys[k] in lookup), None)
+    if start is None:
+        raise ValueError("The ring is not made of edges of the graph")
+
+    arcs = []
+    k = start
+    while k < start + n:
+        if keys[k % n] not in lookup:
+            raise ValueError("The ring is not made of edges of the graph")
+        edge, backwards = lookup[keys[k % n]]
+        arcs.append(~edge if backwards else edge)
+        k += n_points[edge] - 1
+
+    return arcs
+
+
+# edges of the planar graph of a skeleton (uint8 or bool image, non-zero = skeleton), as linestrings in pixel
+# coordinates (column, row), as for cv2.findContours. The nodes are the pixels that do not have exactly two links
+# (ends and junctions), an edge joins two nodes through a chain of pixels with two links; closed chains without node
+# (e.g. an isolated parcel) are closed edges
+def skeleton_edges(skeleton):
+
+    width = skeleton.shape[1]
+    pixels = np.flatnonzero(skeleton)
+    n = len(pixels)
+    if n == 0:
+        return np.array([], dtype=object)
+
+    links = pixel_links(pixels, width)
+    degree = np.bincount(links.ravel(), minlength=n)
+    node = degree != 2
+
+    # links between two nodes are edges on their own
+    node_pairs = links[node[links[:, 0]] & node[links[:, 1]]]
+
+    # chains: connected components of the links between pixels of degree 2
+    chain_links = links[~node[links[:, 0]] & ~node[links[:, 1]]]
+    graph = sparse.coo_matrix((np.ones(len(chain_links), dtype=np.int8), (chain_links[:, 0], chain_links[:, 1])),
+                              shape=(n, n)).tocsr()
+    n_labels, labels = csgraph.connected_components(graph, directed=False)
+
+    # node(s) linked to each pixel of degree 2 (the ends of the chains)
+    node_links = links[node[links[:, 0]] != node[links[:, 1]]]
+    node_links = np.where(node[node_links[:, 0]][:, None], node_links[:, ::-1], node_links) # (chain pixel, node)
+    first_node, second_node = np.full(n, -1), np.full(n, -1)
+    order = np.argsort(node_links[:, 0], kind='stable')
+    node_links = node_links[order]
+    first = np.r_[True, node_links[1:, 0] != node_links[:-1, 0]]
+    first_node[node_links[first, 0]] = node_links[first, 1]
+    second_node[node_links[~first, 0]] = node_links[~first, 1]
+
+    chain = ~node
+    if chain.any():
+        # start of each chain: its first end pixel, or its first pixel if it is closed (one of its links is then cut)
+        chain_pixels = np.flatnonzero(chain)
+        is_end = first_node[chain_pixels] >= 0
+        starts_end = np.full(n_labels, n)
+        np.minimum.at(starts_end, labels[chain_pixels[is_end]], chain_pixels[is_end])
+        starts_any = np.full(n_labels, n)
+        np.minimum.at(starts_any, labels[chain_pixels], chain_pixels)
+        closed = (starts_end == n) & (starts_any < n)
+        starts = np.where(closed, starts_any, starts_end)
+        chain_labels = np.flatnonzero(starts < n)
+        starts = starts[chain_labels]
+
+        # cut one link of each closed chain, at its start: the links go from a pixel to a pixel further in the raster,
+        # so the start (first pixel of the chain) is the first pixel of both of its links
+        closed_starts = starts[closed[chain_labels]]
+        cut = graph.indices[graph.indptr[closed_starts]]
+        keep = ~np.isin(chain_links[:, 0]*n + chain_links[:, 1], closed_starts*n + cut)
+
+        # breadth first search from a virtual pixel linked to all starts: along a chain, pixels come in chain order
+        rows = np.concatenate((chain_links[keep, 0], np.full(len(starts), n)))
+        cols = np.concatenate((chain_links[keep, 1], starts))
+        walk = sparse.coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n + 1, n + 1)).tocsr()
+        visited = csgraph.breadth_first_order(walk, n, directed=False, return_predecessors=False)[1:]
+        visited = visited[np.argsort(labels[visited], kind='stable')]
+
+        # edge of each chain: node, pixels of the chain, node (or the first pixel again if the chain is closed)
+        sizes = np.bincount(labels[visited], minlength=n_labels)[chain_labels]
+        heads = visited[np.cumsum(sizes) - sizes]
+        tails = visited[np.cumsum(sizes) - 1]
+        is_closed = closed[chain_labels]
+        prefix = np.where(is_closed, -1, first_node[heads])
+        suffix = np.where(is_closed, heads, np.where(sizes == 1, second_node[heads], first_node[tails]))
+
+        offsets = np.cumsum(sizes + 2) - (sizes + 2)
+        sequence = np.full(int(np.sum(sizes + 2)), -1)
+        sequence[offsets] = prefix
+        sequence[offsets + sizes + 1] = suffix
+        sequence[np.repeat(offsets + 1, sizes) + np.arange(len(visited)) - np.repeat(np.cumsum(sizes) - sizes, sizes)] = visited
+        edge_ids = np.repeat(np.arange(len(sizes)), sizes + 2)
+        # closed chains have no node in front
+        valid = sequence >= 0
+        chain_sequence, chain_ids = sequence[valid], edge_ids[valid]
+    else:
+        chain_sequence, chain_ids = np.array([], dtype=int), np.array([], dtype=int)
+
+    sequence = np.concatenate((node_pairs.ravel(), chain_sequence))
+    edge_ids = np.concatenate((np.repeat(np.arange(len(node_pairs)), 2), chain_ids + len(node_pairs)))
+    points = np.column_stack((pixels[sequence] % width, pixels[sequence] // width)).astype(np.float64)
+
+    return shapely.linestrings(points, indices=edge_ids)
+
+
+# save faces (polygons) as a topojson file (topojson_path) with the edges as arcs (each one stored once), properties:
+# one dictionary per face. The edges and faces should have the same coordinates (see graph_faces), the coordinates are
+# written as they are (e.g. longitude first) and not quantized
+def write_topojson(topojson_path, edges, faces, properties):
+
+    face_index, edge_index = face_edges(edges, faces)
+    order = np.argsort(face_index, kind='stable')
+    face_index, edge_index = face_index[order], edge_index[order]
+    bounds = np.searchsorted(face_index, np.arange(len(faces) + 1))
+
+    coordinates = [shapely.get_coordinates(edge) for edge in edges]
+    n_points = [len(c) for c in coordinates]
+
+    arc_ids = {} # index of each edge among the arcs of the file, in the order of first use
+    geometries = []
+    for k, face in enumerate(faces):
+        lookup = {}
+        for edge in edge_index[bounds[k]:bounds[k + 1]]:
+            c = coordinates[edge]
+            lookup[(tuple(c[0]), tuple(c[1]))] = (int(edge), False)
+            lookup[(tuple(c[-1]), tuple(c[-2]))] = (int(edge), True)
+
+        polygon = []
+        for ring in [face.exterior] + list(face.interiors):
+            arcs = ring_arcs(shapely.get_coordinates(ring), lookup, n_points)
+            polygon.append([arc_ids.setdefault(a, len(arc_ids)) if a >= 0 else ~arc_ids.setdefault(~a, len(arc_ids))
+                            for a in arcs])
+        geometries.append({"type": "Polygon", "arcs": polygon, "properties": properties[k]})
+
+    topology = {"type": "Topology",
+                "objects": {"parcels": {"type": "GeometryCollection", "geometries": geometries}},
+                "arcs": [coordinates[edge].tolist() for edge in arc_ids]}
+
+    with open(topojson_path, 'w') as f:
+        json.dump(topology, f)
@@ -25,132 +25,97 @@ generate geojson files
 
 
 import cv2 # read image, create contours
-import geojson
+import json
 import numpy as np # mathematical functions on multi-dimensional arrays and matrices
-import pyproj
+import shapely # vectorized geometry constructors (shapely 2)
 import shapely.geometry
 
-from geojson import dump # write a geojson file
 from osgeo import gdal
-from pyproj import Geod
-from shapely.geometry import Polygon # create a polygon
 from shapely.geometry import shape
-from shapely.ops import transform # coordinate conversion
 from shapely.validation import make_valid
 
-from skimage.morphology import skeletonize # skeletonize a binary image
+# parcels of the skeleton, the same for both variants
+from parcels_2023_03 import (contour_polygons, contours_from_mask, filter_by_pixel_area, generalize_parcels,
+                             geodesic_area_mask, geodesic_pixel_area, georeference, label_parcels, of_format,
+                             output_path, parcel_exteriors, permute_coordinates, pixel_degrees, raw_geojson_path,
+                             remove_small_areas, revectorize_changes, save_labels, skeletonize_mask, towgs84,
+                             write_features, write_geojson, PRESIMPLIFY_SHARE, STAIRCASE_PIXELS, VECTOR_EXTENSIONS)
+from skeleton_graph_2023_03 import face_adjacency, graph_faces, skeleton_edges, write_topojson # parcels as faces of a graph
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor # postprocess many sheets on several cores
+from itertools import repeat
 
 
 import time 
 # starting time
 start = time.time()
 
-
-# generate contours from masks
-def contours_from_mask (image):     
-    # we are interested in the contours of the inner polygons only. for this, we generate both outer and inner contours and remove the outer ones through filtering
-    # RETR_EXTERNAL, see doc at https://docs.opencv.org/4.x/d9/d8b/tutorial_py_contours_hierarchy.html
-    # https://docs.opencv.org/2.4/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html?highlight=findcontours#findcontours
+# thresholds (degrees) of the two douglas generalizations of the postprocessing of this variant, before and after the
+# removal of the small areas; douglas_thresh is not used by the postprocessing
+DOUGLAS_FIRST = 1e-6
+DOUGLAS_FINAL = 5e-6
+
+
+# write the raw geojson of the parcels (wgs84 polygons, longitude first) and their properties, and postprocess it with
+# the engine (see generate_polygons)
+def export_parcels (parcels_lonlat, properties, raw_path, engine, runs_num, douglas_thresh, delraw, vector_format): 
+    # the native engine works on the parcels in memory, so the raw geojson is only written if it is kept
+    if engine != 'native' or not delraw: 
+        print("Saving raw geojson file at...", raw_path) 
+        write_geojson(raw_path, parcels_lonlat, properties)
+    elif os.path.exists(raw_path): 
+        # the raw geojson of a previous run would not match the parcels anymore
+        os.remove(raw_path)
     
-    inner_polygons = []
-
-    # generate inner+outer contours
-    contours_ei, hierarchy_ei = cv2.findContours(image, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
-    contours_ei = map(np.squeeze, contours_ei)  # removing redundant dimensions
-    li_contours_ei = list(contours_ei) # convert to list
-
-    # generate outer contours only
-    contours_e, hierarchy_e = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours_e = map(np.squeeze, contours_e)  # removing redundant dimensions
-    li_contours_e = list(contours_e)  # convert to list
-
-    # go through all inner+outer contours
-    for item in li_contours_ei:
-        
-        if (is_relevant_contour(item, li_contours_e)): # keep only those that are relevant (i.e. number of points > 3 and no outer contour)
-            inner_polygons.append(item)
-                
-    return inner_polygons
-
-# georeference pixel coordinates, formula from https://gdal.org/tutorials/geotransforms_tut.html
-def georeference (contour, gt): 
-    georef =  []
-    for point in contour: 
-        x_geo = gt[0] + point[0] * gt[1] + point[1] * gt[2]
-        y_geo = gt[3] + point[0] * gt[4] + point[1] * gt[5]
-        georef.append([x_geo, y_geo])
-    return georef
-
-# check if the file provided as input is of a given format
-def of_format(data_format, source_file): 
+    if engine == 'native': 
+        postprocess_native (parcels_lonlat, properties, output_path(raw_path, vector_format), douglas_thresh, vector_format)
+        return
+    if engine is None: 
+        return
     
-    file_format = source_file.rsplit(".", 1)[1]
-    
-    if (file_format == data_format): 
-        return True
-    else:
-        return False
-
-# keep only polygons that have an area greater than a threshold
-def filter_by_geodesic_area (threshold, polygons):
-    
-    # use the WGS84 ellipsoid to calculate the geodesic area
-    geod = Geod(ellps="WGS84")
-
-    filtered_polygons = [poly for poly in polygons 
-                         if abs(geod.geometry_area_perimeter(poly)[0]) >= threshold]
-    
-    return filtered_polygons
-
-
-# check if the contour is relevant for further processing
-def is_relevant_contour (item, all_external_contours): 
-    # remove contours (i.e. polygons) that have only two points    
-    if (len(item)) < 3: 
-        return False
-    else:
-        for i in all_external_contours: # remove external contours
-            if np.array_equal(item, i): 
-                return False
-        return True
-
-def parcel_ID(parcel): 
-
-    return parcel['properties']['parcelID']   
+    # run postprocessing
+    postprocess (runs_num, raw_path, douglas_thresh, vector_format) 
 
+    # delete raw polygons if specified
+    if delraw:
+        os.remove(raw_path) 
+        print("Raw polygons GeoJSON file deleted.")
 
-# permute coordinate of polygons (if needed)
-def permute_coordinates (x):
-    # map_tuples executes a function over all coordinates: https://geojson.readthedocs.io/en/latest/#map-tuples
-    return geojson.utils.map_tuples(lambda c: (c[1], c[0]), x)
+# run the GRASS GIS steps of the postprocessing in the mapset of the current session: import the raw polygons geojson 
+# (raw_path), perform generalization, clean polygons without attributes, export in vector_format (out_path) and remove
+# the maps; ctstr: added to the names of the maps
+def grass_steps (ctstr, raw_path, out_path, douglas_thresh, vector_format='GeoJSON'): 
+    # import grass python libraries
+    from grass.pygrass.modules.shortcuts import general as g
+    from grass.pygrass.modules.shortcuts import vector as v
 
-# convert from utm coordinate to wgs84
-def towgs84 (x, source_epsg): 
-    utm = pyproj.CRS(source_epsg)
-    wgs84 = pyproj.CRS('EPSG:4326')
-    project = pyproj.Transformer.from_crs(utm, wgs84).transform
-    poly = transform(project, x)
-    return poly
+    #GRASS CAN'T REPLACE EXISTING NAMES, ALWAYS NEED TO USE NEW ONES FOR EVERY STEP
+    #FOR THIS REASON I INTRODUCE A COUNTER TO BE USED IN NAMES
+    #Use underscores in tool names
+    v.in_ogr(input=raw_path, output="read"+ctstr, overwrite = True, snap=1e-10)
+    v.generalize(input='read'+ctstr, method='douglas', threshold=DOUGLAS_FIRST, output='gen'+ctstr, overwrite = True)
+    v.clean(input='gen'+ctstr, tool='rmarea', threshold=1, output='cl'+ctstr)
+    v.generalize(input='cl'+ctstr, method='douglas', threshold=DOUGLAS_FINAL, output='gfin'+ctstr, overwrite = True)
+    v.out_ogr(input='gfin'+ctstr, output=out_path, format=vector_format)
+    
+    # the maps are not needed anymore, removing them keeps the mapset small when it is reused for other sheets
+    g.remove(type='vector', name=[name + ctstr for name in ['read', 'gen', 'cl', 'gfin']], flags='f')
 
-def postprocess (runs_num, raw_path, douglas_thresh): 
+def postprocess (runs_num, raw_path, douglas_thresh, vector_format='GeoJSON'): 
     # Postprocessing : import the raw polygons geojson, perform generalization, 
     # clean polygons without attributes and export as geojson using GRASS GIS 7.8.
     
     print("Post-processing...") 
     ctstr=str(runs_num)
-    out_path=raw_path[:-12]+".geojson"
+    out_path=output_path(raw_path, vector_format)
 
     mygisdb = '/tmp/grassdata'+ctstr
     mylocation = 'world'+ctstr
     mymapset = 'user'+ctstr
 
     from grass_session import Session
-    from grass.script import core as gcore
-    import grass.script as gscript
-    import grass.script.setup as gsetup
-    # import grass python libraries
-    from grass.pygrass.modules.shortcuts import vector as v
 
     # create a PERMANENT mapset object: create a Session instance
     PERMANENT = Session()
@@ -161,24 +126,97 @@ def postprocess (runs_num, raw_path, douglas_thresh):
     user = Session()
     user.open(gisdb=mygisdb, location=mylocation, mapset=mymapset, create_opts='')
 
-    #GRASS CAN'T REPLACE EXISTING NAMES, ALWAYS NEED TO USE NEW ONES FOR EVERY STEP
-    #FOR THIS REASON I INTRODUCE A COUNTER TO BE USED IN NAMES
-    #Use underscores in tool names
-    v.in_ogr(input=raw_path, output="read"+ctstr, overwrite = True, snap=1e-10)
-    v.generalize(input='read'+ctstr, method='douglas', threshold=1e-6, output='gen'+ctstr, overwrite = True)
-    v.clean(input='gen'+ctstr, tool='rmarea', threshold=1, output='cl'+ctstr)
-    v.generalize(input='cl'+ctstr, method='douglas', threshold=5e-6, output='gfin'+ctstr, overwrite = True)
-    v.out_ogr(input='gfin'+ctstr, output=out_path, format='GeoJSON')
+    grass_steps(ctstr, raw_path, out_path, douglas_thresh, vector_format)
+    
+    print("Post-processing finished, output is exported at: ", out_path) 
+
+# postprocess many raw polygons geojson files (e.g. all sheets of a campaign) with GRASS GIS 7.8: the location is created
+# once in a temporary gisdb, the files are split between the worker processes, each one runs its share in its own mapset
+# (see postprocess_share), and the gisdb is deleted at the end
+# returns the paths of the postprocessed geojson files, in the order of raw_paths (same naming as postprocess)
+def postprocess_batch (raw_paths, douglas_thresh, workers=1, vector_format='GeoJSON'): 
+    from grass_session import Session
+    
+    print(f"Post-processing {len(raw_paths)} files with {workers} workers...") 
+    gisdb = tempfile.mkdtemp(prefix='grassdata')
+    try: 
+        # create the location once, through its PERMANENT mapset
+        PERMANENT = Session()
+        PERMANENT.open(gisdb=gisdb, location='world', create_opts='EPSG:4326')
+        PERMANENT.close()
+        
+        # a GRASS session lives in the environment of its process, hence one process (and mapset) per share
+        shares = [list(share) for share in np.array_split(np.array(raw_paths, dtype=object), workers) if len(share) > 0]
+        with ProcessPoolExecutor(max_workers=workers) as executor: 
+            out_paths = list(executor.map(postprocess_share, repeat(gisdb), [f"worker{k}" for k in range(len(shares))], 
+                                          shares, repeat(douglas_thresh), repeat(vector_format)))
+    finally: 
+        shutil.rmtree(gisdb, ignore_errors=True)
+    
+    print("Post-processing finished, outputs are exported next to the raw files") 
+    return [out_path for share in out_paths for out_path in share]
+
+def postprocess_native (parcels, properties, out_path, douglas_thresh, vector_format='GeoJSON'): 
+    # Postprocessing without GRASS GIS: the steps of postprocess (douglas generalization with DOUGLAS_FIRST, removal of 
+    # the areas smaller than 1 m^2, douglas generalization with DOUGLAS_FINAL, export in vector_format), run in memory on the parcels
+    # (longitude first)
+    # properties: those of each parcel (parcelID, ...), cat is added as v.out_ogr does
+    
+    print("Post-processing (native)...") 
+    areas, parcel_ids = generalize_parcels(parcels, np.arange(1, len(parcels) + 1), DOUGLAS_FIRST)
+    areas, parcel_ids = remove_small_areas(areas, parcel_ids, 1)
+    areas, parcel_ids = generalize_parcels(areas, parcel_ids, DOUGLAS_FINAL)
+    
+    write_features(out_path, areas, [{"cat": int(parcel_id), **properties[parcel_id - 1]} for parcel_id in parcel_ids], 
+                   vector_format)
     
     print("Post-processing finished, output is exported at: ", out_path) 
 
+# postprocess a share of the files of postprocess_batch, one after the other, in the mapset of the worker
+def postprocess_share (gisdb, mapset, raw_paths, douglas_thresh, vector_format): 
+    from grass_session import Session
+    
+    user = Session()
+    user.open(gisdb=gisdb, location='world', mapset=mapset, create_opts='')
+    out_paths = []
+    try: 
+        for k, raw_path in enumerate(raw_paths): 
+            out_path = output_path(raw_path, vector_format)
+            grass_steps(f"{mapset}_{k}", raw_path, out_path, douglas_thresh, vector_format)
+            out_paths.append(out_path)
+    finally: 
+        user.close()
     
+    return out_paths
 
 # (ENTRY) function to generate polygons as geojson files - it reuses the functions defined above
+# engine: 'grass' (postprocessing with GRASS GIS), 'native' (in memory, without GRASS GIS, see postprocess_native)
+# or None (no postprocessing, only the raw geojson is written, e.g. to postprocess many sheets with postprocess_batch)
+# tile_size: the skeleton is thinned tile_size x tile_size pixels at a time (see skeletonize_mask)
+# polygonizer: 'contours' (one contour per parcel), 'graph' (faces of the graph of the skeleton, the edges are simplified
+# with DOUGLAS_FIRST; the neighbours of each parcel are saved as _adjacency.json, and the parcels as topojson if
+# topojson_path is given) or 'labels' (components between the boundaries, see label_parcels; the label image is saved as
+# _labels.tif and the label of each parcel as labelID)
+# vector_format: format of the postprocessed output, 'GeoJSON', 'FlatGeobuf' or 'GPKG' (see VECTOR_EXTENSIONS)
+# presimplify: with polygonizer='contours', the contours are simplified in pixel space before they are georeferenced
+# (staircases, and a share of DOUGLAS_FIRST, see STAIRCASE_PIXELS and PRESIMPLIFY_SHARE)
+# previous_boundaries_path: boundaries of the previous run with polygonizer='labels' and the same geojson_path (its raw
+# geojson kept, delraw=False), e.g. before they were corrected by hand: only the parcels around the changed pixels are
+# vectorized again (see revectorize_changes), the other ones keep their parcelID; the postprocessing is run on all parcels
 def generate_polygons (geotiff_path, boundaries_path, source_epsg, geojson_path, 
-            area_thresh, runs_num, douglas_thresh, delraw): 
+            area_thresh, runs_num, douglas_thresh, delraw, engine='grass', tile_size=4096, polygonizer='contours', 
+            topojson_path=None, vector_format='GeoJSON', previous_boundaries_path=None, presimplify=False): 
+    
+    if engine not in ('grass', 'native', None):
+        raise ValueError(f"Unknown postprocessing engine: {engine} (expected 'grass', 'native' or None)")
+    if polygonizer not in ('contours', 'graph', 'labels'):
+        raise ValueError(f"Unknown polygonizer: {polygonizer} (expected 'contours', 'graph' or 'labels')")
+    if vector_format not in VECTOR_EXTENSIONS:
+        raise ValueError(f"Unknown vector format: {vector_format} (expected one of {', '.join(VECTOR_EXTENSIONS)})")
+    if previous_boundaries_path is not None and polygonizer != 'labels':
+        raise ValueError("The incremental mode (previous_boundaries_path) needs polygonizer='labels'")
     
-    raw_path=geojson_path[:-5]+"_raw.geojson"
+    raw_path=raw_geojson_path(geojson_path)
     kernel_size = 6
     
     n_dilations = 5
@@ -214,83 +252,102 @@ def generate_polygons (geotiff_path, boundaries_path, source_epsg, geojson_path,
     img_post = cv2.morphologyEx(morph1, cv2.MORPH_CLOSE, kernel)
     '''
     img_post = img
+    pixel_area = geodesic_pixel_area(gt, source_epsg, img.shape[1], img.shape[0])
+    
+    if previous_boundaries_path is not None: 
+        # incremental mode: the parcels of the previous run are updated around the changes of the boundaries
+        labels_path = raw_path[:-12]+"_labels.tif"
+        if not os.path.exists(raw_path) or not os.path.exists(labels_path): 
+            raise ValueError(f"The incremental mode needs the raw geojson and the label raster of the previous run: {raw_path}, {labels_path}")
+        previous_img = cv2.imread(previous_boundaries_path, 0)
+        if previous_img is None or previous_img.shape != img.shape: 
+            raise ValueError(f"The previous boundaries {previous_boundaries_path} do not have the size of {boundaries_path}")
+        print("Previous boundaries read from...", previous_boundaries_path)
+        
+        with open(raw_path) as f: 
+            features = json.load(f)['features']
+        if any('labelID' not in feature['properties'] for feature in features): 
+            raise ValueError(f"The parcels of {raw_path} have no labelID, they were not generated with polygonizer='labels'")
+        parcels_lonlat, properties = revectorize_changes(img_post, previous_img, 
+                                                         np.array([shape(feature['geometry']) for feature in features], dtype=object), 
+                                                         [feature['properties'] for feature in features], labels_path, gt, 
+                                                         source_epsg, area_thresh, pixel_area, tile_size)
+        print(f"Number of parcels: {len(parcels_lonlat)}; min area per parcel: {area_thresh} m^2")
+        print("Label raster updated at...", labels_path)
+        export_parcels(parcels_lonlat, properties, raw_path, engine, runs_num, douglas_thresh, delraw, vector_format)
+        return
  
     print("Generating the skeleton from the image...")
-    image = img_post/255.0 # skeletonize needs image with only 0 and 1 as values
-    skel = skeletonize(image)
-    skeleton = skel.astype(np.uint8) # we need a convertion to an unsigned byte for further processing
-    skeleton*= 255 # if necessary, we may save the skeleton here
-    
-    
-    # Generate contours from mask 
-    contours = contours_from_mask(skeleton) 
-    print("Done. Number of polygons from the image's skeleton: ", len(contours))
+    # the non-zero pixels are the foreground, the mask is thinned in a uint8 copy of it (no float copy)
+    skeleton = skeletonize_mask(img_post, tile_size) # if necessary, we may save the skeleton here
     
-    print("Georefencing the polygons...")
     
-    skel_polygons = []
-    for cnt in contours: 
-        if(len(cnt) >= 3): 
-            # 1 - transform coordinates of contours into georeferenced (projected coordinates)
-            # 2- build a polygon from the projected coordinates
-            # 3- transform the projected coordinates into geographic coordinates
-            poly_utm = Polygon(georeference(cnt, gt))
-            # https://shapely.readthedocs.io/en/stable/manual.html#constructive-methods
-            poly_buffer = poly_utm.buffer(0, join_style=2) # 2 = mitre
-            poly_wgs84 = towgs84(poly_buffer, source_epsg) 
-            new_polygon = poly_wgs84
-
-            skel_polygons.append(new_polygon)
+    edges = None
+    polygon_labels = None
+    if polygonizer == 'graph': 
+        # the parcels are the faces of the graph of the skeleton, so that each edge (boundary between parcels) is 
+        # georeferenced, converted to wgs84 and simplified once, see skeleton_graph_2023_03
+        print("Building the graph of the skeleton...")
+        edges = skeleton_edges(skeleton)
+        edges = towgs84(shapely.transform(edges, lambda points: georeference(points, gt)), source_epsg)
+        edges = shapely.simplify(edges, DOUGLAS_FIRST, preserve_topology=False)
+        skel_polygons = list(graph_faces(edges))
+        estimated_areas = None
+        print("Done. Number of polygons from the graph of the skeleton: ", len(skel_polygons))
+    elif polygonizer == 'labels': 
+        # the parcels are the components between the boundaries, the small ones are dropped from their statistics
+        print("Labelling the parcels between the boundaries...")
+        label_image, polygon_labels, contours = label_parcels(skeleton, area_thresh, pixel_area)
+        print("Done. Number of polygons from the labels: ", len(contours))
+        skel_polygons, estimated_areas = contour_polygons(contours, gt, source_epsg, pixel_area)
+    else: 
+        # Generate contours from mask, simplified in pixel space if requested (DOUGLAS_FIRST is in degrees)
+        tolerance = 0
+        if presimplify: 
+            tolerance = max(STAIRCASE_PIXELS, PRESIMPLIFY_SHARE*DOUGLAS_FIRST/pixel_degrees(gt, source_epsg, img.shape[1], img.shape[0]))
+        contours = contours_from_mask(skeleton, tolerance) 
+        print("Done. Number of polygons from the image's skeleton: ", len(contours))
+        contours = [cnt for cnt in contours if len(cnt) >= 3]
+        
+        # polygons clearly smaller than area_thresh are dropped before any georeferencing
+        n_contours = len(contours)
+        contours = filter_by_pixel_area(area_thresh, contours, pixel_area)
+        print(f"Polygons dropped before georeferencing (clearly below {area_thresh} m^2): {n_contours - len(contours)}")
+        skel_polygons, estimated_areas = contour_polygons(contours, gt, source_epsg, pixel_area)
          
-    parcels_hole = filter_by_geodesic_area(area_thresh, skel_polygons)  
+    keep = geodesic_area_mask(area_thresh, skel_polygons, estimated_areas)
+    parcels_hole = [poly for poly, kept in zip(skel_polygons, keep) if kept]
     print(f"Number of parcels: {len(parcels_hole)}; min area per parcel: {area_thresh} m^2")
     
-    #fixing the holes - Keeping the exterior ring only from every polygon
-    #some polygons are multipolygons, so two options are needed
-    parcels=[]
-    for poly in parcels_hole:
-        if poly.geom_type == 'MultiPolygon':
-            try:
-                Polygons = list(poly)# do multipolygon things.
-                for multiparts in Polygons:
-                    new_polygon = Polygon(multiparts.exterior.coords, holes=None)
-                    parcels.append(new_polygon)
-            except:
-                print("a multipolygon is skipped, resolve this after testing")
-            #Polygons = list(poly['geom'].iloc[0].geoms)# do multipolygon things.
-        elif poly.geom_type == 'Polygon':
-            new_polygon = Polygon(poly.exterior.coords, holes=None)
-            parcels.append(new_polygon)
-        else:
-            print("Error: not a polygon")
+    parcels, origins = parcel_exteriors(parcels_hole)
     
     
-   # Generate GeoJSON data
-    geo_dict_pre = {}
-    geo_dict_pre["type"] = "FeatureCollection"
-    geo_dict_pre["features"] = [{"type": "Feature", 
-                             "geometry": permute_coordinates(a),
-                             "properties": { "parcelID": "n/a", "parcelType": "n/a"}} 
-                             for a in [shapely.geometry.mapping(b) for b in parcels]]
-    
-    for index, parcel in enumerate(geo_dict_pre["features"]): 
-        parcel['properties']['parcelID'] = index + 1
-           
-    geo_dict_final = geo_dict_pre
-    print("Saving raw geojson file at...", raw_path) 
+   # Generate the features: longitude first, as in the geojson files
+    parcels_lonlat = permute_coordinates(np.asarray(parcels, dtype=object))
+    properties = [{"parcelID": index + 1, "parcelType": "n/a"} for index in range(len(parcels))]
     
-    # Save GeoJSON file
-    # https://gis.stackexchange.com/questions/130963/write-geojson-into-a-geojson-file-with-python
-    with open(raw_path, 'w') as f:
-       dump(geo_dict_final, f)
+    if polygon_labels is not None: 
+        # label of each parcel in the label image, saved next to the geojson for the later stages
+        parcel_labels = polygon_labels[keep][origins]
+        for label, parcel_properties in zip(parcel_labels, properties): 
+            parcel_properties['labelID'] = int(label)
+        labels_path = raw_path[:-12]+"_labels.tif"
+        save_labels(labels_path, label_image, parcel_labels, gt, info['coordinateSystem']['wkt'])
+        print("Label raster saved at...", labels_path)
     
-    # run postprocessing
-    postprocess (runs_num, raw_path, douglas_thresh) 
-
-    # delete raw polygons if specified
-    if delraw:
-        os.remove(raw_path) 
-        print("Raw polygons GeoJSON file deleted.")
+    if edges is not None: 
+        # neighbours of each parcel (parcelIDs), from the edges they share
+        neighbours = face_adjacency(edges, parcels)
+        adjacency_path = raw_path[:-12]+"_adjacency.json"
+        with open(adjacency_path, 'w') as f:
+            json.dump({index + 1: [k + 1 for k in parcel_neighbours] for index, parcel_neighbours in enumerate(neighbours)}, f)
+        print("Parcel adjacency saved at...", adjacency_path)
+        
+        if topojson_path is not None: 
+            write_topojson(topojson_path, permute_coordinates(edges), parcels_lonlat, properties)
+            print("Topojson saved at...", topojson_path)
+           
+    export_parcels(parcels_lonlat, properties, raw_path, engine, runs_num, douglas_thresh, delraw, vector_format)
 
 # end time
 end = time.time()